@@ -2,102 +2,485 @@ import requests
 import json
 import os
 import sys
-from database import get_db_connection
+import time
+import hashlib
+import threading
+from datetime import datetime, timedelta
+from requests.adapters import HTTPAdapter
+from database import get_pool, sqlite3
+from cache import LRUCache, cached_lookup, SETTINGS_CACHE_TTL
 
 DB_FILE = "tickets.db"
+DEFAULT_MODEL = "mistral"
 
-def get_ollama_endpoint(db_password):
+# --- Ollama Client Settings ---
+OLLAMA_CONNECT_TIMEOUT = float(os.environ.get('OLLAMA_CONNECT_TIMEOUT', 5))
+OLLAMA_READ_TIMEOUT = float(os.environ.get('OLLAMA_READ_TIMEOUT', 120))
+OLLAMA_MAX_RETRIES = int(os.environ.get('OLLAMA_MAX_RETRIES', 2))
+OLLAMA_RETRY_BACKOFF = float(os.environ.get('OLLAMA_RETRY_BACKOFF', 0.5))
+OLLAMA_MAX_CONCURRENCY = int(os.environ.get('OLLAMA_MAX_CONCURRENCY', 2))
+OLLAMA_QUEUE_TIMEOUT = float(os.environ.get('OLLAMA_QUEUE_TIMEOUT', 60))
+
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+# --- Model Routing Settings ---
+# Used for an operation with no row in ai_models.
+DEFAULT_ROUTE = {
+    'model': DEFAULT_MODEL, 'endpoint': None, 'fallback_model': None, 'fallback_endpoint': None,
+    'max_concurrency': OLLAMA_MAX_CONCURRENCY, 'timeout_seconds': OLLAMA_READ_TIMEOUT,
+}
+AI_CALL_RETENTION_DAYS = float(os.environ.get('AI_CALL_RETENTION_DAYS', 30))
+AI_CALL_PRUNE_EVERY = 500
+
+# --- AI Result Cache Settings ---
+AI_CACHE_TTL_DAYS = float(os.environ.get('AI_CACHE_TTL_DAYS', 30))
+AI_CACHE_MAX_ROWS = int(os.environ.get('AI_CACHE_MAX_ROWS', 10000))
+AI_CACHE_MEMORY_SIZE = int(os.environ.get('AI_CACHE_MEMORY_SIZE', 256))
+AI_CACHE_PRUNE_EVERY = 100
+
+PROMPT_TEMPLATES = {
+    'summarize': "Summarize the following text, taking into account the provided context:\n\n{text}",
+    'sanitize': "Remove all personally identifiable information (PII) from the following text, replacing it with placeholders like [NAME], [EMAIL], [PHONE], etc. Leave existing placeholders in square brackets as they are:\n\n{text}",
+    'chat': "Based on the following context, answer the user's question.\n\nContext:\n{context}\n\nQuestion: {question}",
+}
+# Chat answers depend on the conversation, so only deterministic-input operations are cached.
+CACHED_OPERATIONS = {'summarize', 'sanitize'}
+
+def get_ollama_endpoint(con):
     """Reads the Ollama endpoint from the database."""
+    creds = con.execute("SELECT api_endpoint FROM api_keys WHERE service = 'ollama'").fetchone()
+    if not creds:
+        raise ValueError("Ollama endpoint not found in the database.")
+    return creds[0]
+
+def get_endpoint():
+    """
+    Returns the Ollama endpoint, re-read from the database at most every SETTINGS_CACHE_TTL
+    seconds, or None if it can't be read. Failures are not cached, so the next call retries.
+    """
+    pool = _db_pool()
+    if pool is None:
+        # Raised rather than exiting: this runs on web and queue worker threads.
+        raise OllamaNotConfigured("The database is locked, so the Ollama endpoint can't be read.")
+    def load():
+        with pool.connection() as con:
+            return get_ollama_endpoint(con)
     try:
-        # Note: This function as-is requires a direct password.
-        # In a real app, this should be handled more securely.
-        con = get_db_connection(db_password)
-        cur = con.cursor()
-        cur.execute("SELECT api_endpoint FROM api_keys WHERE service = 'ollama'")
-        creds = cur.fetchone()
-        con.close()
-        if not creds:
-            raise ValueError("Ollama endpoint not found in the database.")
-        return creds[0]
+        return cached_lookup('api_endpoint', load, key='ollama', ttl=SETTINGS_CACHE_TTL)
     except Exception as e:
         print(f"Database error while fetching Ollama endpoint: {e}", file=sys.stderr)
         return None
 
-OLLAMA_ENDPOINT = None
+class OllamaError(Exception):
+    """Raised when a generation request to Ollama fails or times out."""
 
-def get_endpoint():
-    global OLLAMA_ENDPOINT
-    if OLLAMA_ENDPOINT is None:
-        DB_MASTER_PASSWORD = os.environ.get('DB_MASTER_PASSWORD')
-        if not DB_MASTER_PASSWORD:
-            sys.exit("FATAL: DB_MASTER_PASSWORD environment variable not set for AI processing.")
-        OLLAMA_ENDPOINT = get_ollama_endpoint(DB_MASTER_PASSWORD)
-    return OLLAMA_ENDPOINT
-
-def summarize_text(text):
-    """Summarizes text using the Ollama Mistral model."""
-    endpoint = get_endpoint()
-    if not endpoint:
-        return "Ollama endpoint not configured."
-
-    prompt = f"Summarize the following text, taking into account the provided context:\n\n{text}"
+class OllamaNotConfigured(OllamaError):
+    """Raised when no Ollama endpoint is stored in the database."""
+
+class ModelSlots:
+    """
+    Caps concurrent generations of one model on one endpoint. Each caller brings the
+    limit of its own route, and a new call only starts while fewer calls are in flight
+    than the smallest limit among them and the running calls, so routes sharing a
+    model with different limits never push it past either.
+    """
+
+    def __init__(self):
+        self._held = []
+        self._ready = threading.Condition()
+
+    def acquire(self, limit, timeout):
+        deadline = time.monotonic() + timeout
+        with self._ready:
+            while len(self._held) >= min([limit] + self._held):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._ready.wait(remaining)
+            self._held.append(limit)
+            return True
+
+    def release(self, limit):
+        with self._ready:
+            self._held.remove(limit)
+            self._ready.notify_all()
+
+class OllamaClient:
+    """
+    Shared HTTP client for Ollama. Keeps connections alive in a pooled Session,
+    applies connect/read timeouts, retries transient failures with backoff and
+    caps how many requests are in flight on each endpoint, and how many
+    generations of each model.
+    """
+
+    def __init__(self, connect_timeout=OLLAMA_CONNECT_TIMEOUT, read_timeout=OLLAMA_READ_TIMEOUT,
+                 max_retries=OLLAMA_MAX_RETRIES, retry_backoff=OLLAMA_RETRY_BACKOFF,
+                 max_concurrency=OLLAMA_MAX_CONCURRENCY, queue_timeout=OLLAMA_QUEUE_TIMEOUT):
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.max_concurrency = max_concurrency
+        self.queue_timeout = queue_timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max(max_concurrency, 1))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._endpoint_slots = {}
+        self._model_slots = {}
+        self._model_in_flight = {}
+        self._lock = threading.Lock()
+        self._stats = {
+            'requests': 0, 'retries': 0, 'failures': 0, 'rejected': 0,
+            'in_flight': 0, 'waiting': 0,
+            'latency_total': 0.0, 'first_token_total': 0.0, 'completed': 0,
+        }
+
+    def _count(self, stat, amount=1):
+        with self._lock:
+            self._stats[stat] += amount
+
+    def _endpoint_slots_for(self, endpoint):
+        """Returns the semaphore capping all requests in flight on one endpoint."""
+        with self._lock:
+            slots = self._endpoint_slots.get(endpoint)
+            if slots is None:
+                slots = self._endpoint_slots[endpoint] = threading.BoundedSemaphore(self.max_concurrency)
+            return slots
+
+    def _model_slots_for(self, endpoint, model):
+        with self._lock:
+            slots = self._model_slots.get((endpoint, model))
+            if slots is None:
+                slots = self._model_slots[(endpoint, model)] = ModelSlots()
+            return slots
+
+    def _count_model(self, model, amount):
+        with self._lock:
+            self._model_in_flight[model] = self._model_in_flight.get(model, 0) + amount
+
+    def _post(self, url, payload, timeout=None):
+        """POSTs with retries on connection errors and retryable HTTP statuses."""
+        attempt = 0
+        while True:
+            try:
+                response = self.session.post(url, json=payload, stream=True, timeout=timeout or self.timeout)
+                if response.status_code in RETRYABLE_STATUS and attempt < self.max_retries:
+                    response.close()
+                    raise requests.exceptions.HTTPError(f"{response.status_code} from Ollama", response=response)
+                response.raise_for_status()
+                return response
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.HTTPError) as e:
+                status = getattr(e.response, 'status_code', None)
+                retryable = status is None or status in RETRYABLE_STATUS
+                if not retryable or attempt >= self.max_retries:
+                    raise OllamaError(str(e)) from e
+                attempt += 1
+                self._count('retries')
+                time.sleep(self.retry_backoff * (2 ** (attempt - 1)))
+
+    def stream_generate(self, endpoint, prompt, model=DEFAULT_MODEL, max_concurrency=None, read_timeout=None):
+        """Yields response tokens as Ollama streams them."""
+        limit = max_concurrency or self.max_concurrency
+        model_slots = self._model_slots_for(endpoint, model)
+        endpoint_slots = self._endpoint_slots_for(endpoint)
+        # The model slot is taken first so a call waiting on a busy model doesn't hold an endpoint slot.
+        queued = time.monotonic()
+        self._count('waiting')
+        acquired = model_slots.acquire(limit, self.queue_timeout)
+        if acquired and not endpoint_slots.acquire(timeout=max(self.queue_timeout - (time.monotonic() - queued), 0)):
+            model_slots.release(limit)
+            acquired = False
+        self._count('waiting', -1)
+        if not acquired:
+            self._count('rejected')
+            raise OllamaError(f"Ollama is busy: no generation slot free for {model} after {self.queue_timeout}s.")
+        self._count('requests')
+        self._count('in_flight')
+        self._count_model(model, 1)
+        started = time.monotonic()
+        first_token_at = None
+        timeout = (self.timeout[0], read_timeout) if read_timeout else None
+        try:
+            response = self._post(f"{endpoint}/api/generate", {"model": model, "prompt": prompt}, timeout=timeout)
+            with response:
+                for line in response.iter_lines():
+                    if not line:
+                        continue
+                    decoded_line = json.loads(line.decode('utf-8'))
+                    if decoded_line.get("error"):
+                        raise OllamaError(decoded_line["error"])
+                    token = decoded_line.get("response", "")
+                    if token:
+                        if first_token_at is None:
+                            first_token_at = time.monotonic()
+                        yield token
+            with self._lock:
+                self._stats['completed'] += 1
+                self._stats['latency_total'] += time.monotonic() - started
+                if first_token_at is not None:
+                    self._stats['first_token_total'] += first_token_at - started
+        except (requests.exceptions.RequestException, ValueError) as e:
+            self._count('failures')
+            raise OllamaError(str(e)) from e
+        except OllamaError:
+            self._count('failures')
+            raise
+        finally:
+            self._count('in_flight', -1)
+            self._count_model(model, -1)
+            endpoint_slots.release()
+            model_slots.release(limit)
+
+    def embed(self, endpoint, text, model):
+        """Returns the embedding vector Ollama computes for a text."""
+        slots = self._endpoint_slots_for(endpoint)
+        if not slots.acquire(timeout=self.queue_timeout):
+            self._count('rejected')
+            raise OllamaError(f"Ollama is busy: no slot free after {self.queue_timeout}s.")
+        self._count('in_flight')
+        try:
+            response = self._post(f"{endpoint}/api/embeddings", {"model": model, "prompt": text})
+            with response:
+                embedding = response.json().get("embedding")
+            if not embedding:
+                raise OllamaError("Ollama returned no embedding.")
+            return embedding
+        except (requests.exceptions.RequestException, ValueError) as e:
+            self._count('failures')
+            raise OllamaError(str(e)) from e
+        finally:
+            self._count('in_flight', -1)
+            slots.release()
+
+    def metrics(self):
+        """Returns a snapshot of request counts, concurrency and latency."""
+        with self._lock:
+            stats = dict(self._stats)
+            model_in_flight = dict(self._model_in_flight)
+        completed = stats['completed'] or 1
+        return {
+            'model_in_flight': model_in_flight,
+            'max_concurrency': self.max_concurrency,
+            'in_flight': stats['in_flight'],
+            'waiting': stats['waiting'],
+            'requests': stats['requests'],
+            'completed': stats['completed'],
+            'retries': stats['retries'],
+            'failures': stats['failures'],
+            'rejected': stats['rejected'],
+            'latency_ms_avg': round(stats['latency_total'] / completed * 1000, 1),
+            'first_token_ms_avg': round(stats['first_token_total'] / completed * 1000, 1),
+        }
+
+_client = None
+_client_lock = threading.Lock()
+
+def get_client():
+    """Returns the process-wide Ollama client."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = OllamaClient()
+        return _client
+
+# --- AI Result Cache ---
+_result_cache = LRUCache(maxsize=AI_CACHE_MEMORY_SIZE, ttl=AI_CACHE_TTL_DAYS * 86400)
+_cache_writes = 0
+
+def cache_key(operation, model, text):
+    """Hashes (operation, model, prompt template, input text) into a cache key."""
+    digest = hashlib.sha256()
+    for part in (operation, model, PROMPT_TEMPLATES[operation], text):
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+_pool = None
+
+def use_pool(pool):
+    """Makes AI processing read its endpoint, routes and cache through the given connection pool."""
+    global _pool
+    _pool = pool
+
+def _db_pool():
+    if _pool is not None:
+        return _pool
+    password = os.environ.get('DB_MASTER_PASSWORD')
+    return get_pool(password) if password else None
+
+def get_cached_result(key):
+    """Returns a cached result from memory or the encrypted DB, or None."""
+    result = _result_cache.get(key)
+    if result is not None:
+        return result
+    pool = _db_pool()
+    if pool is None:
+        return None
+    now = datetime.now()
+    cutoff = (now - timedelta(days=AI_CACHE_TTL_DAYS)).isoformat(timespec='seconds')
     try:
-        response = requests.post(
-            f"{endpoint}/api/generate",
-            json={"model": "mistral", "prompt": prompt},
-            stream=True
-        )
-        response.raise_for_status()
-        summary = ""
-        for line in response.iter_lines():
-            if line:
-                decoded_line = json.loads(line.decode('utf-8'))
-                summary += decoded_line.get("response", "")
-        return summary
-    except requests.exceptions.RequestException as e:
-        return f"Error communicating with Ollama: {e}"
-
-def sanitize_text(text):
-    """Sanitizes text by removing PII using the Ollama Mistral model."""
-    endpoint = get_endpoint()
-    if not endpoint:
-        return "Ollama endpoint not configured."
-    prompt = f"Remove all personally identifiable information (PII) from the following text, replacing it with placeholders like [NAME], [EMAIL], [PHONE], etc.:\n\n{text}"
+        with pool.connection() as con:
+            row = con.execute("SELECT result FROM ai_cache WHERE cache_key = ? AND created_at >= ?", (key, cutoff)).fetchone()
+            if row is None:
+                return None
+            con.execute("UPDATE ai_cache SET last_used_at = ? WHERE cache_key = ?", (now.isoformat(timespec='seconds'), key))
+            con.commit()
+    except sqlite3.Error as e:
+        print(f"AI cache read failed: {e}", file=sys.stderr)
+        return None
+    _result_cache.set(key, row['result'])
+    return row['result']
+
+def store_cached_result(key, operation, model, result):
+    """Stores a result in memory and in the encrypted DB, pruning old rows now and then."""
+    global _cache_writes
+    _result_cache.set(key, result)
+    pool = _db_pool()
+    if pool is None:
+        return
+    now = datetime.now().isoformat(timespec='seconds')
     try:
-        response = requests.post(
-            f"{endpoint}/api/generate",
-            json={"model": "mistral", "prompt": prompt},
-            stream=True
+        with pool.connection() as con:
+            con.execute("INSERT OR REPLACE INTO ai_cache (cache_key, operation, model, result, created_at, last_used_at) VALUES (?, ?, ?, ?, ?, ?)",
+                        (key, operation, model, result, now, now))
+            _cache_writes += 1
+            if _cache_writes % AI_CACHE_PRUNE_EVERY == 0:
+                prune_cache(con)
+            con.commit()
+    except sqlite3.Error as e:
+        print(f"AI cache write failed: {e}", file=sys.stderr)
+
+def prune_cache(con):
+    """Deletes cache rows past the TTL and the least recently used rows beyond AI_CACHE_MAX_ROWS."""
+    cutoff = (datetime.now() - timedelta(days=AI_CACHE_TTL_DAYS)).isoformat(timespec='seconds')
+    con.execute("DELETE FROM ai_cache WHERE created_at < ?", (cutoff,))
+    con.execute("""
+        DELETE FROM ai_cache WHERE cache_key IN (
+            SELECT cache_key FROM ai_cache ORDER BY last_used_at DESC LIMIT -1 OFFSET ?
         )
-        response.raise_for_status()
-        sanitized_text = ""
-        for line in response.iter_lines():
-            if line:
-                decoded_line = json.loads(line.decode('utf-8'))
-                sanitized_text += decoded_line.get("response", "")
-        return sanitized_text
-    except requests.exceptions.RequestException as e:
-        return f"Error communicating with Ollama: {e}"
-
-def chat_with_context(context, question):
-    """Answers a question based on the provided context using the Ollama Mistral model."""
-    endpoint = get_endpoint()
-    if not endpoint:
-        return "Ollama endpoint not configured."
-
-    prompt = f"Based on the following context, answer the user's question.\n\nContext:\n{context}\n\nQuestion: {question}"
+    """, (AI_CACHE_MAX_ROWS,))
+
+def cache_metrics():
+    return _result_cache.metrics()
+
+# --- AI Operations ---
+def build_prompt(operation, **fields):
+    return PROMPT_TEMPLATES[operation].format(**fields)
+
+def get_route(operation):
+    """
+    Returns the model routing for an operation from ai_models, re-read at most every
+    SETTINGS_CACHE_TTL seconds. Falls back to DEFAULT_ROUTE, uncached, if the DB can't be read.
+    """
+    pool = _db_pool()
+    if pool is None:
+        return dict(DEFAULT_ROUTE)
+    def load():
+        route = dict(DEFAULT_ROUTE)
+        with pool.connection() as con:
+            row = con.execute("SELECT * FROM ai_models WHERE operation = ?", (operation,)).fetchone()
+        if row:
+            route.update({name: row[name] for name in DEFAULT_ROUTE if row[name] is not None})
+        return route
     try:
-        response = requests.post(
-            f"{endpoint}/api/generate",
-            json={"model": "mistral", "prompt": prompt},
-            stream=True
-        )
-        response.raise_for_status()
-        answer = ""
-        for line in response.iter_lines():
-            if line:
-                decoded_line = json.loads(line.decode('utf-8'))
-                answer += decoded_line.get("response", "")
-        return answer
-    except requests.exceptions.RequestException as e:
-        return f"Error communicating with Ollama: {e}"
+        return cached_lookup('ai_models', load, key=operation, ttl=SETTINGS_CACHE_TTL)
+    except sqlite3.Error as e:
+        print(f"Database error while reading the model route for {operation}: {e}", file=sys.stderr)
+        return dict(DEFAULT_ROUTE)
+
+def route_attempts(route, model=None):
+    """Returns the (route_name, model, endpoint) attempts for a route: the primary, then any fallback."""
+    attempts = [('primary', model or route['model'], route['endpoint'])]
+    if route['fallback_model'] or route['fallback_endpoint']:
+        attempts.append(('fallback', route['fallback_model'] or attempts[0][1], route['fallback_endpoint'] or route['endpoint']))
+    return attempts
+
+def cached_operation_result(operation, text, attempts=None):
+    """
+    Returns the cached result of an operation on the given text, from whichever of
+    the routed models produced it, or None.
+    """
+    for _, attempt_model, _ in attempts or route_attempts(get_route(operation)):
+        cached = get_cached_result(cache_key(operation, attempt_model, text))
+        if cached is not None:
+            return cached
+    return None
+
+_call_writes = 0
+
+def record_ai_call(operation, model, endpoint, route, status, latency, first_token=None, error=None):
+    """Logs one generation attempt to ai_calls for latency and routing reports. Best effort."""
+    global _call_writes
+    pool = _db_pool()
+    if pool is None:
+        return
+    now = datetime.now()
+    try:
+        with pool.connection() as con:
+            con.execute("""
+                INSERT INTO ai_calls (operation, model, endpoint, route, status, latency_ms, first_token_ms, error, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (operation, model, endpoint, route, status, round(latency * 1000, 1),
+                  round(first_token * 1000, 1) if first_token is not None else None, error, now.isoformat(timespec='seconds')))
+            _call_writes += 1
+            if _call_writes % AI_CALL_PRUNE_EVERY == 0:
+                cutoff = (now - timedelta(days=AI_CALL_RETENTION_DAYS)).isoformat(timespec='seconds')
+                con.execute("DELETE FROM ai_calls WHERE created_at < ?", (cutoff,))
+            con.commit()
+    except sqlite3.Error as e:
+        print(f"AI call log write failed: {e}", file=sys.stderr)
+
+def run_operation(operation, model=None, **fields):
+    """
+    Runs an AI operation and returns its text, serving cacheable operations from
+    the result cache. Raises OllamaError on failure so callers can tell errors from results.
+    """
+    return "".join(stream_operation(operation, model=model, **fields))
+
+def stream_operation(operation, model=None, **fields):
+    """
+    Yields the operation's output as tokens arrive from Ollama, on the model routed for the
+    operation (or the given model). If the primary fails before producing any output, the
+    route's fallback is tried. A cached result is yielded in one piece; a completed
+    generation is stored in the cache. Raises OllamaError on failure.
+    """
+    route = get_route(operation)
+    attempts = route_attempts(route, model)
+
+    if operation in CACHED_OPERATIONS:
+        cached = cached_operation_result(operation, fields['text'], attempts)
+        if cached is not None:
+            yield cached
+            return
+
+    prompt = build_prompt(operation, **fields)
+    last_error = None
+    for route_name, attempt_model, endpoint in attempts:
+        endpoint = endpoint or get_endpoint()
+        if not endpoint:
+            last_error = OllamaNotConfigured("Ollama endpoint not configured.")
+            continue
+        started = time.monotonic()
+        first_token = None
+        parts = []
+        try:
+            for token in get_client().stream_generate(endpoint, prompt, model=attempt_model,
+                                                      max_concurrency=route['max_concurrency'],
+                                                      read_timeout=route['timeout_seconds']):
+                if first_token is None:
+                    first_token = time.monotonic() - started
+                parts.append(token)
+                yield token
+        except OllamaError as e:
+            record_ai_call(operation, attempt_model, endpoint, route_name, 'error', time.monotonic() - started, first_token, str(e))
+            # Output already sent to the caller can't be taken back, so only a clean failure falls back.
+            if parts:
+                raise
+            last_error = e
+            print(f"[{datetime.now()}] AI: {operation} on {attempt_model} ({route_name}) failed: {e}", file=sys.stderr)
+            continue
+        record_ai_call(operation, attempt_model, endpoint, route_name, 'ok', time.monotonic() - started, first_token)
+        if operation in CACHED_OPERATIONS:
+            store_cached_result(cache_key(operation, attempt_model, fields['text']), operation, attempt_model, "".join(parts))
+        return
+    raise last_error
@@ -0,0 +1,396 @@
+import os
+import sys
+import json
+import time
+import queue
+import threading
+from datetime import datetime, timedelta
+from database import get_pool
+from ai_processing import stream_operation, use_pool, OllamaError, OllamaNotConfigured
+from embeddings import index_replies, retrieve_snippets
+from ticket_context import build_ticket_context
+from pii import redact, get_name_matcher
+
+# --- AI Job Queue Settings ---
+AI_WORKERS = int(os.environ.get('AI_WORKERS', 2))
+AI_BULK_WORKERS = int(os.environ.get('AI_BULK_WORKERS', 1))
+AI_JOB_RETENTION_DAYS = float(os.environ.get('AI_JOB_RETENTION_DAYS', 7))
+# How often workers look for delayed jobs and jobs queued by other processes.
+AI_JOB_POLL_SECONDS = float(os.environ.get('AI_JOB_POLL_SECONDS', 5))
+# A burst of replies to one ticket pushes its summary back, up to the max delay.
+SUMMARY_DEBOUNCE_SECONDS = float(os.environ.get('SUMMARY_DEBOUNCE_SECONDS', 120))
+SUMMARY_MAX_DELAY_SECONDS = float(os.environ.get('SUMMARY_MAX_DELAY_SECONDS', 900))
+# How long finished jobs keep their streamed tokens in memory for late listeners.
+LIVE_JOB_SECONDS = 120
+
+# Lower runs first: interactive chat ahead of one-off tools, ahead of bulk work.
+JOB_PRIORITIES = {'chat': 0, 'sanitize': 1, 'summarize': 2}
+BULK_PRIORITY = 9
+OPERATION_FIELDS = {'summarize': ('text',), 'sanitize': ('text', 'deep'), 'chat': ('context', 'question'), 'embed': ()}
+
+def now_iso():
+    return datetime.now().isoformat(timespec='seconds')
+
+def build_chat_context(con, ticket_id, question):
+    """
+    Builds chat context from the ticket's own thread, within the token budget, plus the
+    past replies of the same company most relevant to the question. Returns
+    (context, replies_needing_summary); the context is None without a ticket.
+    """
+    if not ticket_id:
+        # History is scoped to the ticket's company, so there is nothing to retrieve without one.
+        return None, []
+    context, needs_summary = build_ticket_context(con, ticket_id)
+    ticket = con.execute("SELECT company_id FROM tickets WHERE id = ?", (ticket_id,)).fetchone()
+    try:
+        snippets = retrieve_snippets(con, question, ticket['company_id'], exclude_ticket_id=ticket_id) if ticket else None
+    except OllamaError as e:
+        print(f"[{datetime.now()}] AI QUEUE: retrieval failed, answering from the ticket alone: {e}", file=sys.stderr)
+        snippets = None
+    if snippets:
+        history = "\n\n".join(snippets)
+        context = f"{context}\n\nRELEVANT HISTORY:\n{history}" if context else f"RELEVANT HISTORY:\n{history}"
+    return context, needs_summary
+
+def enqueue_job(con, operation, dedupe_key, ticket_id=None, payload=None, delay=0, max_delay=None):
+    """
+    Queues a background job on an open connection, without committing.
+    A job with the same dedupe key already waiting is pushed back instead of
+    duplicated (never past max_delay after it was first queued).
+    """
+    now = datetime.now()
+    pending = con.execute("SELECT id, created_at FROM ai_jobs WHERE dedupe_key = ? AND status = 'queued'", (dedupe_key,)).fetchone()
+    if pending:
+        not_before = now + timedelta(seconds=delay)
+        if max_delay is not None:
+            not_before = min(not_before, datetime.fromisoformat(pending['created_at']) + timedelta(seconds=max_delay))
+        con.execute("UPDATE ai_jobs SET not_before = ? WHERE id = ?", (not_before.isoformat(timespec='seconds'), pending['id']))
+        return pending['id']
+    not_before = (now + timedelta(seconds=delay)).isoformat(timespec='seconds')
+    cur = con.execute("INSERT INTO ai_jobs (operation, priority, ticket_id, payload, dedupe_key, not_before, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                      (operation, BULK_PRIORITY, ticket_id, json.dumps(payload or {}), dedupe_key, not_before, now.isoformat(timespec='seconds')))
+    return cur.lastrowid
+
+def enqueue_ticket_job(con, operation, ticket_id, delay=0, max_delay=None):
+    """Queues a background job for a ticket, merging it with one of the same kind already waiting."""
+    return enqueue_job(con, operation, f"{operation}:ticket:{ticket_id}", ticket_id=ticket_id, delay=delay, max_delay=max_delay)
+
+def enqueue_reply_summaries(con, replies):
+    """
+    Queues bulk summaries of single replies. They land in the AI cache, where the
+    context builder picks them up in place of excerpts next time.
+    """
+    for reply in replies:
+        enqueue_job(con, 'summarize', f"summarize:reply:{reply['id']}", payload={'text': reply['text']})
+
+def enqueue_ticket_summary(con, ticket_id):
+    """
+    Queues a background summary of a ticket. A burst of replies pushes the summary
+    back, so it runs once the thread goes quiet.
+    """
+    return enqueue_ticket_job(con, 'summarize', ticket_id, delay=SUMMARY_DEBOUNCE_SECONDS, max_delay=SUMMARY_MAX_DELAY_SECONDS)
+
+def enqueue_ticket_embedding(con, ticket_id):
+    """Queues embedding of a ticket's new replies for chat retrieval."""
+    return enqueue_ticket_job(con, 'embed', ticket_id)
+
+class JobProgress:
+    """Tokens produced so far by a running job, shared with any streaming listeners."""
+
+    def __init__(self):
+        self.tokens = []
+        self.done = False
+        self.result = None
+        self.error = None
+        self.finished_at = None
+        self.condition = threading.Condition()
+
+    def add(self, token):
+        with self.condition:
+            self.tokens.append(token)
+            self.condition.notify_all()
+
+    def finish(self, result=None, error=None):
+        with self.condition:
+            self.done = True
+            self.result = result
+            self.error = error
+            self.finished_at = time.monotonic()
+            self.condition.notify_all()
+
+class AIJobQueue:
+    """
+    A bounded pool of worker threads draining AI jobs in priority order.
+    Bulk jobs have their own smaller lane so they never occupy the interactive workers.
+    Jobs are persisted in the ai_jobs table, so queued work survives a restart and
+    jobs queued by other processes (like the email watcher) are picked up by polling.
+    """
+
+    def __init__(self, password, workers=AI_WORKERS, bulk_workers=AI_BULK_WORKERS):
+        self.pool = get_pool(password)
+        # Resumed jobs may run before anything else has told ai_processing how to reach the DB.
+        use_pool(self.pool)
+        self.workers = workers
+        self.bulk_workers = bulk_workers
+        self._queue = queue.PriorityQueue()
+        self._bulk_queue = queue.PriorityQueue()
+        self._enqueued = set()
+        self._enqueued_lock = threading.Lock()
+        self._live = {}
+        self._live_lock = threading.Lock()
+        self._threads = []
+        self._stopping = threading.Event()
+        self._stats = {'submitted': 0, 'completed': 0, 'failed': 0, 'running': 0}
+        self._stats_lock = threading.Lock()
+
+    def _count(self, stat, amount=1):
+        with self._stats_lock:
+            self._stats[stat] += amount
+
+    def start(self):
+        """Re-queues persisted work and starts the worker threads."""
+        with self.pool.connection() as con:
+            # Jobs that were running when the process stopped never finished.
+            con.execute("UPDATE ai_jobs SET status = 'queued' WHERE status = 'running'")
+            cutoff = (datetime.now() - timedelta(days=AI_JOB_RETENTION_DAYS)).isoformat(timespec='seconds')
+            con.execute("DELETE FROM ai_jobs WHERE status IN ('done', 'failed') AND finished_at < ?", (cutoff,))
+            con.commit()
+        resumed = self._poll_due_jobs()
+        if resumed:
+            print(f"--- AI queue: resumed {resumed} queued job(s) ---")
+        lanes = [(self._queue, f"ai-worker-{i}") for i in range(self.workers)]
+        lanes += [(self._bulk_queue, f"ai-bulk-worker-{i}") for i in range(self.bulk_workers)]
+        for lane, name in lanes:
+            thread = threading.Thread(target=self._worker, args=(lane,), name=name, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        poller = threading.Thread(target=self._poller, name="ai-queue-poller", daemon=True)
+        poller.start()
+        self._threads.append(poller)
+
+    def stop(self):
+        self._stopping.set()
+
+    def _enqueue(self, priority, job_id):
+        with self._enqueued_lock:
+            if job_id in self._enqueued:
+                return False
+            self._enqueued.add(job_id)
+        lane = self._bulk_queue if priority >= BULK_PRIORITY else self._queue
+        lane.put((priority, job_id))
+        return True
+
+    def _poll_due_jobs(self):
+        """Queues persisted jobs that are due and not yet held in memory. Returns how many were added."""
+        with self.pool.connection() as con:
+            due = con.execute("""
+                SELECT id, priority FROM ai_jobs
+                WHERE status = 'queued' AND (not_before IS NULL OR not_before <= ?)
+                ORDER BY priority, id
+            """, (now_iso(),)).fetchall()
+        return sum(1 for job in due if self._enqueue(job['priority'], job['id']))
+
+    def _poller(self):
+        while not self._stopping.wait(AI_JOB_POLL_SECONDS):
+            try:
+                self._poll_due_jobs()
+            except Exception as e:
+                print(f"[{datetime.now()}] AI QUEUE: polling failed: {e}", file=sys.stderr)
+
+    def submit(self, operation, fields, priority=None, ticket_id=None):
+        """Persists a job and queues it. Returns the job id."""
+        if operation not in OPERATION_FIELDS:
+            raise ValueError(f"Unknown AI operation: {operation}")
+        if priority is None:
+            priority = JOB_PRIORITIES.get(operation, BULK_PRIORITY)
+        payload = {name: fields.get(name) or '' for name in OPERATION_FIELDS[operation]}
+        with self.pool.connection() as con:
+            cur = con.execute("INSERT INTO ai_jobs (operation, priority, ticket_id, payload, created_at) VALUES (?, ?, ?, ?, ?)",
+                              (operation, priority, ticket_id, json.dumps(payload), now_iso()))
+            job_id = cur.lastrowid
+            con.commit()
+        with self._live_lock:
+            self._prune_live()
+            self._live[job_id] = JobProgress()
+        self._count('submitted')
+        self._enqueue(priority, job_id)
+        return job_id
+
+    def get(self, job_id):
+        """Returns the persisted state of a job as a dict, or None."""
+        with self.pool.connection() as con:
+            row = con.execute("SELECT id, operation, priority, status, ticket_id, result, error, created_at, started_at, finished_at FROM ai_jobs WHERE id = ?",
+                              (job_id,)).fetchone()
+        return dict(row) if row else None
+
+    def stream(self, job_id, timeout=600):
+        """
+        Yields ('token', text) as the job produces output, then ('done', result)
+        or ('error', message). Jobs no longer held in memory yield their stored outcome.
+        """
+        with self._live_lock:
+            progress = self._live.get(job_id)
+        if progress is None:
+            job = self.get(job_id)
+            if job is None:
+                yield 'error', "Job not found."
+            elif job['status'] == 'done':
+                yield 'done', job['result']
+            elif job['status'] == 'failed':
+                yield 'error', job['error']
+            else:
+                yield 'error', "Job is queued; poll its status instead."
+            return
+
+        sent = 0
+        deadline = time.monotonic() + timeout
+        while True:
+            with progress.condition:
+                while len(progress.tokens) == sent and not progress.done:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    progress.condition.wait(remaining)
+                tokens = progress.tokens[sent:]
+                done, result, error = progress.done, progress.result, progress.error
+            sent += len(tokens)
+            for token in tokens:
+                yield 'token', token
+            if done:
+                if error:
+                    yield 'error', error
+                else:
+                    yield 'done', result
+                return
+            if time.monotonic() >= deadline:
+                yield 'error', "Timed out waiting for the job to finish."
+                return
+
+    def _prune_live(self):
+        cutoff = time.monotonic() - LIVE_JOB_SECONDS
+        for job_id in [job_id for job_id, p in self._live.items() if p.done and p.finished_at < cutoff]:
+            del self._live[job_id]
+
+    def _worker(self, lane):
+        while not self._stopping.is_set():
+            try:
+                priority, job_id = lane.get(timeout=1)
+            except queue.Empty:
+                continue
+            try:
+                self._run(job_id)
+            except Exception as e:
+                print(f"[{datetime.now()}] AI QUEUE: job {job_id} crashed: {e}", file=sys.stderr)
+            finally:
+                with self._enqueued_lock:
+                    self._enqueued.discard(job_id)
+
+    def _run(self, job_id):
+        with self.pool.connection() as con:
+            # A debounced job may have been pushed back after it was queued in memory;
+            # leave it for the poller in that case.
+            now = now_iso()
+            cur = con.execute("""
+                UPDATE ai_jobs SET status = 'running', started_at = ?, attempts = attempts + 1
+                WHERE id = ? AND status = 'queued' AND (not_before IS NULL OR not_before <= ?)
+            """, (now, job_id, now))
+            con.commit()
+            if cur.rowcount == 0:
+                return
+            job = con.execute("SELECT operation, ticket_id, payload FROM ai_jobs WHERE id = ?", (job_id,)).fetchone()
+
+        with self._live_lock:
+            progress = self._live.setdefault(job_id, JobProgress())
+        self._count('running')
+        result, error = None, None
+        try:
+            result = self._execute(job, progress)
+        except OllamaNotConfigured as e:
+            error = str(e)
+        except OllamaError as e:
+            error = f"Error communicating with Ollama: {e}"
+        except Exception as e:
+            # Anything else must still settle the job, or it stays 'running' and listeners hang.
+            error = f"Job failed: {e}"
+            print(f"[{datetime.now()}] AI QUEUE: job {job_id} failed: {e}", file=sys.stderr)
+        finally:
+            self._count('running', -1)
+            try:
+                self._store_outcome(job_id, job, result, error)
+            except Exception as e:
+                error = error or f"Could not store the job result: {e}"
+                print(f"[{datetime.now()}] AI QUEUE: could not store the outcome of job {job_id}: {e}", file=sys.stderr)
+            self._count('failed' if error else 'completed')
+            progress.finish(result=None if error else result, error=error)
+
+    def _execute(self, job, progress):
+        """Builds the job's prompt from the DB where needed and runs it. Returns the result text."""
+        fields = json.loads(job['payload'])
+        deep = fields.pop('deep', None)
+        with self.pool.connection() as con:
+            # Ticket jobs build their prompt from the DB rather than trusting posted text.
+            needs_summary = []
+            if job['operation'] == 'summarize' and job['ticket_id']:
+                context, needs_summary = build_ticket_context(con, job['ticket_id'])
+                fields['text'] = context or ''
+            elif job['operation'] == 'sanitize' and job['ticket_id']:
+                context, _ = build_ticket_context(con, job['ticket_id'], budget=None, include_notes=False)
+                fields['text'] = context or fields['text']
+            elif job['operation'] == 'chat':
+                context, needs_summary = build_chat_context(con, job['ticket_id'], fields['question'])
+                fields['context'] = context or fields['context']
+            if job['operation'] == 'sanitize':
+                # Known PII is redacted locally; only deep mode sends the residue to the model.
+                fields['text'], _ = redact(fields['text'], get_name_matcher(con))
+            if needs_summary:
+                enqueue_reply_summaries(con, needs_summary)
+                con.commit()
+
+        if job['operation'] == 'embed':
+            with self.pool.connection() as con:
+                return f"Indexed {index_replies(con, job['ticket_id'])} new replies."
+        if job['operation'] == 'sanitize' and not deep:
+            progress.add(fields['text'])
+            return fields['text']
+        parts = []
+        for token in stream_operation(job['operation'], **fields):
+            parts.append(token)
+            progress.add(token)
+        return "".join(parts)
+
+    def _store_outcome(self, job_id, job, result, error):
+        with self.pool.connection() as con:
+            if error:
+                con.execute("UPDATE ai_jobs SET status = 'failed', error = ?, finished_at = ? WHERE id = ?",
+                            (error, now_iso(), job_id))
+            else:
+                con.execute("UPDATE ai_jobs SET status = 'done', result = ?, finished_at = ? WHERE id = ?",
+                            (result, now_iso(), job_id))
+                if job['operation'] == 'summarize' and job['ticket_id']:
+                    con.execute("UPDATE tickets SET summary = ? WHERE id = ?", (result, job['ticket_id']))
+            con.commit()
+
+    def metrics(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['workers'] = self.workers
+        stats['bulk_workers'] = self.bulk_workers
+        stats['queued'] = self._queue.qsize()
+        stats['bulk_queued'] = self._bulk_queue.qsize()
+        return stats
+
+_job_queue = None
+_job_queue_lock = threading.Lock()
+
+def start_queue(password, workers=AI_WORKERS):
+    """Starts the process-wide AI job queue once; later calls return the running queue."""
+    global _job_queue
+    with _job_queue_lock:
+        if _job_queue is None:
+            _job_queue = AIJobQueue(password, workers=workers)
+            _job_queue.start()
+        return _job_queue
+
+def get_queue():
+    """Returns the running AI job queue, or None before the database is unlocked."""
+    return _job_queue
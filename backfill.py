@@ -0,0 +1,256 @@
+import os
+import sys
+import time
+import getpass
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from database import get_pool, begin_immediate
+from ai_processing import run_operation, OllamaError, OllamaNotConfigured
+from ai_queue import BULK_PRIORITY
+from ticket_context import build_ticket_context
+from pii import store_sanitized_replies, pending_replies_query
+
+# --- Backfill Settings ---
+BACKFILL_WORKERS = int(os.environ.get('BACKFILL_WORKERS', 2))
+# Tickets started per minute across all workers, so the backfill leaves Ollama
+# capacity for interactive users. 0 disables the limit.
+BACKFILL_RATE_PER_MINUTE = float(os.environ.get('BACKFILL_RATE_PER_MINUTE', 30))
+# Tickets read per keyset page; the checkpoint advances once a page is finished.
+BACKFILL_PAGE_SIZE = int(os.environ.get('BACKFILL_PAGE_SIZE', 50))
+# While interactive AI jobs are waiting in the web app, workers hold off this long before re-checking.
+INTERACTIVE_BACKOFF_SECONDS = 5
+# Interactive jobs older than this are assumed orphaned by a crash and ignored.
+INTERACTIVE_JOB_MAX_AGE = timedelta(minutes=10)
+PROGRESS_EVERY_SECONDS = 10
+
+class RateLimiter:
+    """Spaces calls evenly across threads so no more than rate_per_minute start per minute."""
+
+    def __init__(self, rate_per_minute):
+        self.interval = 60.0 / rate_per_minute if rate_per_minute > 0 else 0
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+class Progress:
+    """Counts finished tickets and prints throughput and an ETA at most every PROGRESS_EVERY_SECONDS."""
+
+    def __init__(self, total):
+        self.total = total
+        self.done = 0
+        self.failed = 0
+        self.started = time.monotonic()
+        self._last_report = self.started
+        self._lock = threading.Lock()
+
+    def record(self, ok):
+        with self._lock:
+            self.done += 1
+            if not ok:
+                self.failed += 1
+            due = time.monotonic() - self._last_report >= PROGRESS_EVERY_SECONDS
+            if due:
+                self._last_report = time.monotonic()
+        if due:
+            self.report()
+
+    def report(self):
+        elapsed = time.monotonic() - self.started
+        rate = self.done / elapsed if elapsed else 0
+        remaining = max(self.total - self.done, 0)
+        eta = str(timedelta(seconds=int(remaining / rate))) if rate else "unknown"
+        print(f"[*] {self.done}/{self.total} tickets ({self.failed} failed), {rate * 60:.1f}/min, ETA {eta}")
+
+# --- Checkpoints ---
+def load_checkpoint(con, name):
+    row = con.execute("SELECT * FROM backfill_checkpoints WHERE name = ?", (name,)).fetchone()
+    return dict(row) if row else None
+
+def save_checkpoint(con, name, last_ticket_id, processed, failed):
+    now = datetime.now().isoformat(timespec='seconds')
+    begin_immediate(con)
+    con.execute("""
+        INSERT INTO backfill_checkpoints (name, last_ticket_id, processed, failed, started_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT(name) DO UPDATE SET last_ticket_id = excluded.last_ticket_id, processed = excluded.processed,
+            failed = excluded.failed, updated_at = excluded.updated_at
+    """, (name, last_ticket_id, processed, failed, now, now))
+    con.commit()
+
+def interactive_jobs_waiting(con):
+    """True while the web app has recent chat or one-off AI jobs queued or running."""
+    cutoff = (datetime.now() - INTERACTIVE_JOB_MAX_AGE).isoformat(timespec='seconds')
+    return con.execute("""
+        SELECT 1 FROM ai_jobs WHERE status IN ('queued', 'running') AND priority < ? AND created_at >= ? LIMIT 1
+    """, (BULK_PRIORITY, cutoff)).fetchone() is not None
+
+# --- Backfill ---
+class Backfill:
+    """
+    Walks tickets in id order with a bounded pool of workers, filling in missing
+    summaries and, optionally, sanitized reply copies. Progress is checkpointed
+    after every page, up to the first failed ticket, so a re-run resumes where it
+    stopped and retries failures. Tickets already done are skipped on the way,
+    except with redo.
+    """
+
+    def __init__(self, password, summarize=True, sanitize=False, deep=False, redo=False,
+                 workers=BACKFILL_WORKERS, rate_per_minute=BACKFILL_RATE_PER_MINUTE, page_size=BACKFILL_PAGE_SIZE):
+        self.pool = get_pool(password)
+        self.summarize = summarize
+        self.sanitize = sanitize
+        self.deep = deep
+        self.redo = redo
+        self.workers = workers
+        self.page_size = page_size
+        self.limiter = RateLimiter(rate_per_minute)
+        tasks = [task for task, enabled in (('summarize', summarize), ('sanitize', sanitize)) if enabled]
+        self.name = "+".join(tasks) + (":deep" if sanitize and deep else "")
+        # Summary-only runs can skip tickets that already have one; anything else checks per ticket.
+        self.ticket_filter = "AND summary IS NULL" if summarize and not sanitize and not redo else ""
+
+    def _wait_turn(self):
+        self.limiter.wait()
+        while True:
+            with self.pool.connection() as con:
+                busy = interactive_jobs_waiting(con)
+            if not busy:
+                return
+            time.sleep(INTERACTIVE_BACKOFF_SECONDS)
+
+    def process_ticket(self, ticket_id):
+        """Backfills one ticket. Returns False if the model failed; the ticket is left for a later run."""
+        try:
+            self._wait_turn()
+            with self.pool.connection() as con:
+                context = None
+                if self.summarize:
+                    row = con.execute("SELECT summary FROM tickets WHERE id = ?", (ticket_id,)).fetchone()
+                    if row is None:
+                        # Deleted since its page was read.
+                        return True
+                    if self.redo or not row['summary']:
+                        context, _ = build_ticket_context(con, ticket_id)
+            # Connections go back to the pool while the model works.
+            if context:
+                summary = run_operation('summarize', text=context)
+                with self.pool.connection() as con:
+                    begin_immediate(con)
+                    con.execute("UPDATE tickets SET summary = ? WHERE id = ?", (summary, ticket_id))
+                    con.commit()
+            if self.sanitize:
+                pending, pending_args = pending_replies_query(self.deep, self.redo)
+                with self.pool.connection() as con:
+                    rows = con.execute(f"""
+                        SELECT r.id, r.content FROM ticket_replies r
+                        LEFT JOIN reply_sanitized s ON s.reply_id = r.id
+                        WHERE r.ticket_id = ? AND {pending} ORDER BY r.id
+                    """, (ticket_id, *pending_args)).fetchall()
+                    if rows:
+                        store_sanitized_replies(con, rows, deep=self.deep)
+            return True
+        except OllamaNotConfigured:
+            raise
+        except OllamaError as e:
+            print(f"[!] Ticket {ticket_id}: {e}", file=sys.stderr)
+            return False
+        except Exception as e:
+            print(f"[!] Ticket {ticket_id}: unexpected {type(e).__name__}: {e}", file=sys.stderr)
+            return False
+
+    def run(self, restart=False):
+        """
+        Runs the backfill to the end of the tickets table. Returns (processed, failed): tickets
+        done in all runs so far, and tickets that failed in this one and are left for a re-run.
+        """
+        with self.pool.connection() as con:
+            checkpoint = None if restart else load_checkpoint(con, self.name)
+            last_id = checkpoint['last_ticket_id'] if checkpoint else 0
+            processed = checkpoint['processed'] if checkpoint else 0
+            total = con.execute(f"SELECT COUNT(*) FROM tickets WHERE id > ? {self.ticket_filter}", (last_id,)).fetchone()[0]
+        if checkpoint:
+            print(f"[*] Resuming '{self.name}' after ticket {last_id} ({processed} done, "
+                  f"{checkpoint['failed']} failed last run and retried now).")
+        print(f"[*] {total} tickets to backfill with {self.workers} workers.")
+
+        progress = Progress(total)
+        # The saved checkpoint never passes a failed ticket, so a resumed run retries it;
+        # the walk itself carries on so one bad ticket doesn't hold up the rest. Only tickets
+        # up to the checkpoint count as done in it, so a resumed run doesn't count the rest twice.
+        first_failed = None
+        checkpointed = processed
+        failed = 0
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='backfill') as executor:
+            while True:
+                with self.pool.connection() as con:
+                    ids = [row['id'] for row in con.execute(f"""
+                        SELECT id FROM tickets WHERE id > ? {self.ticket_filter} ORDER BY id LIMIT ?
+                    """, (last_id, self.page_size))]
+                if not ids:
+                    break
+                results = []
+                for ok in executor.map(self.process_ticket, ids):
+                    progress.record(ok)
+                    results.append(ok)
+                if not any(results):
+                    failed += len(ids)
+                    print(f"[!] Every ticket in the last page failed; stopping before ticket {ids[0]}. Re-run to resume.", file=sys.stderr)
+                    break
+                for ticket_id, ok in zip(ids, results):
+                    if not ok:
+                        failed += 1
+                        if first_failed is None:
+                            first_failed = ticket_id
+                    elif first_failed is None:
+                        checkpointed += 1
+                processed += results.count(True)
+                last_id = ids[-1]
+                with self.pool.connection() as con:
+                    save_checkpoint(con, self.name, last_id if first_failed is None else first_failed - 1, checkpointed, failed)
+        progress.report()
+        return processed, failed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fill in AI summaries and sanitized copies for existing tickets.")
+    parser.add_argument('--no-summaries', action='store_true', help="don't generate ticket summaries")
+    parser.add_argument('--sanitize', action='store_true', help="also store sanitized copies of each ticket's replies")
+    parser.add_argument('--deep', action='store_true', help="sanitize through the model as well as the local redaction (slow)")
+    parser.add_argument('--redo', action='store_true', help="regenerate summaries and copies that already exist")
+    parser.add_argument('--restart', action='store_true', help="ignore the saved checkpoint and start from the first ticket")
+    parser.add_argument('--workers', type=int, default=BACKFILL_WORKERS, help="tickets processed in parallel")
+    parser.add_argument('--rate', type=float, default=BACKFILL_RATE_PER_MINUTE, help="max tickets started per minute (0 for no limit)")
+    parser.add_argument('--page-size', type=int, default=BACKFILL_PAGE_SIZE, help="tickets per checkpointed page")
+    args = parser.parse_args()
+    if args.no_summaries and not args.sanitize:
+        sys.exit("Nothing to do: pass --sanitize or drop --no-summaries.")
+
+    DB_MASTER_PASSWORD = os.environ.get('DB_MASTER_PASSWORD')
+    if not DB_MASTER_PASSWORD:
+        try:
+            DB_MASTER_PASSWORD = getpass.getpass("Please enter the database password: ")
+        except (getpass.GetPassWarning, NameError):
+            DB_MASTER_PASSWORD = input("Please enter the database password: ")
+    if not DB_MASTER_PASSWORD:
+        sys.exit("FATAL: No database password provided. Aborting.")
+    # ai_processing reads the endpoint, routes and result cache through the pool opened with this password.
+    os.environ['DB_MASTER_PASSWORD'] = DB_MASTER_PASSWORD
+
+    backfill = Backfill(DB_MASTER_PASSWORD, summarize=not args.no_summaries, sanitize=args.sanitize, deep=args.deep,
+                        redo=args.redo, workers=args.workers, rate_per_minute=args.rate, page_size=args.page_size)
+    try:
+        processed, failed = backfill.run(restart=args.restart)
+    except OllamaNotConfigured as e:
+        sys.exit(f"[!] {e}")
+    except KeyboardInterrupt:
+        sys.exit("\n[!] Interrupted. Re-run to resume from the last checkpoint.")
+    print(f"[*] Backfill '{backfill.name}' finished: {processed} tickets done, {failed} failed.")
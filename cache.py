@@ -0,0 +1,84 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+
+class LRUCache:
+    """A small thread-safe in-process cache with LRU eviction and an optional TTL."""
+
+    def __init__(self, maxsize=256, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, expires_at = entry
+            if expires_at is not None and expires_at < time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def delete_where(self, predicate):
+        with self._lock:
+            for key in [key for key in self._data if predicate(key)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def metrics(self):
+        with self._lock:
+            size = len(self._data)
+        return {'size': size, 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses}
+
+# --- Reference Data Cache ---
+# Rarely changing lookups (companies, assignees, API endpoints) are read through this cache.
+# Write routes invalidate what they change; the TTL bounds staleness for writes made elsewhere.
+REFERENCE_CACHE_TTL = float(os.environ.get('REFERENCE_CACHE_TTL', 300))
+# Settings stored in the DB (API endpoints and credentials, model routes) are re-read
+# within this many seconds of a change, without a restart.
+SETTINGS_CACHE_TTL = float(os.environ.get('SETTINGS_CACHE_TTL', os.environ.get('API_ENDPOINT_TTL', 60)))
+
+_MISSING = object()
+reference_cache = LRUCache(maxsize=256, ttl=REFERENCE_CACHE_TTL)
+
+def cached_lookup(name, loader, key=None, ttl=None):
+    """
+    Returns the cached value for (name, key), calling loader() to fill it on a miss.
+    If loader() raises, nothing is cached and the exception propagates.
+    """
+    cache_key = (name, key)
+    value = reference_cache.get(cache_key, _MISSING)
+    if value is _MISSING:
+        value = loader()
+        reference_cache.set(cache_key, value, ttl)
+    return value
+
+def invalidate(*names):
+    """Drops every cached value under the given names."""
+    reference_cache.delete_where(lambda cache_key: cache_key[0] in names)
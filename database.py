@@ -1,6 +1,10 @@
 import os
 import sys
-from flask import g, current_app
+import time
+import queue
+import threading
+from contextlib import contextmanager
+from flask import g, current_app, has_app_context
 from datetime import datetime, timezone
 
 try:
@@ -11,33 +15,294 @@ except ImportError:
 
 DATABASE = 'tickets.db'
 
+# --- Connection Pool Settings ---
+POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 8))
+POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 10))
+POOL_RECYCLE = float(os.environ.get('DB_POOL_RECYCLE', 3600))
+
+# --- Connection Tuning ---
+# WAL lets the web app read while the email watcher writes; NORMAL sync is durable
+# across application crashes and only risks the last commits on power loss.
+JOURNAL_MODE = os.environ.get('DB_JOURNAL_MODE', 'WAL')
+SYNCHRONOUS = os.environ.get('DB_SYNCHRONOUS', 'NORMAL')
+CACHE_SIZE_KB = int(os.environ.get('DB_CACHE_SIZE_KB', 16384))
+BUSY_TIMEOUT = float(os.environ.get('DB_BUSY_TIMEOUT', 10))
+# Write-lock waits longer than this count as contention in the metrics.
+LOCK_WAIT_THRESHOLD = 0.005
+
+def configure_connection(con):
+    """Applies the journal, sync and cache pragmas to a freshly keyed connection."""
+    con.execute(f"PRAGMA journal_mode = {JOURNAL_MODE};")
+    con.execute(f"PRAGMA synchronous = {SYNCHRONOUS};")
+    con.execute(f"PRAGMA cache_size = -{CACHE_SIZE_KB};")
+    con.execute("PRAGMA temp_store = MEMORY;")
+    con.execute(f"PRAGMA busy_timeout = {int(BUSY_TIMEOUT * 1000)};")
+
 def get_db_connection(password):
     """Establishes a connection to the encrypted database."""
     if not password:
         raise ValueError("A database password is required.")
-    con = sqlite3.connect(DATABASE, timeout=10)
+    con = sqlite3.connect(DATABASE, timeout=BUSY_TIMEOUT)
     con.execute(f"PRAGMA key = '{password}';")
     con.row_factory = sqlite3.Row
+    configure_connection(con)
     return con
 
+# --- Write Transactions ---
+_write_stats = {'transactions': 0, 'contended': 0, 'lock_wait_total': 0.0, 'lock_wait_max': 0.0, 'lock_timeouts': 0}
+_write_stats_lock = threading.Lock()
+
+def begin_immediate(con):
+    """
+    Starts a write transaction, taking the write lock up front rather than on the first
+    write, and records how long it waited for a concurrent writer to finish.
+    """
+    started = time.monotonic()
+    try:
+        con.execute("BEGIN IMMEDIATE")
+    except sqlite3.OperationalError:
+        with _write_stats_lock:
+            _write_stats['lock_timeouts'] += 1
+        raise
+    waited = time.monotonic() - started
+    with _write_stats_lock:
+        _write_stats['transactions'] += 1
+        _write_stats['lock_wait_total'] += waited
+        _write_stats['lock_wait_max'] = max(_write_stats['lock_wait_max'], waited)
+        if waited > LOCK_WAIT_THRESHOLD:
+            _write_stats['contended'] += 1
+
+def write_metrics():
+    """Returns write transaction counts and how long they waited for the database lock."""
+    with _write_stats_lock:
+        stats = dict(_write_stats)
+    transactions = stats['transactions'] or 1
+    return {
+        'transactions': stats['transactions'],
+        'contended': stats['contended'],
+        'lock_timeouts': stats['lock_timeouts'],
+        'lock_wait_ms_avg': round(stats['lock_wait_total'] / transactions * 1000, 3),
+        'lock_wait_ms_max': round(stats['lock_wait_max'] * 1000, 3),
+    }
+
+class PoolTimeout(Exception):
+    """Raised when no pooled connection becomes free within the wait limit."""
+
+class ConnectionPool:
+    """
+    A thread-safe pool of keyed connections to the encrypted database.
+    SQLCipher runs its key derivation the first time a freshly keyed connection
+    touches the file, so connections are keyed once and then reused across requests.
+    """
+
+    def __init__(self, password, max_size=POOL_SIZE, timeout=POOL_TIMEOUT, recycle=POOL_RECYCLE):
+        if not password:
+            raise ValueError("A database password is required.")
+        self.password = password
+        self.max_size = max_size
+        self.timeout = timeout
+        self.recycle = recycle
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created_at = {}
+        self._size = 0
+        self._stats = {
+            'checkouts': 0, 'waits': 0, 'wait_time_total': 0.0, 'wait_time_max': 0.0,
+            'checkout_time_total': 0.0, 'checkout_time_max': 0.0,
+            'opened': 0, 'recycled': 0, 'failed_health_checks': 0, 'timeouts': 0,
+        }
+
+    def _open(self):
+        """Opens, keys and validates a new connection."""
+        con = sqlite3.connect(DATABASE, timeout=BUSY_TIMEOUT, check_same_thread=False)
+        try:
+            con.execute(f"PRAGMA key = '{self.password}';")
+            # Forces the key derivation now so a wrong password fails at checkout time.
+            con.execute("SELECT count(*) FROM sqlite_master").fetchone()
+            configure_connection(con)
+        except sqlite3.DatabaseError:
+            con.close()
+            raise
+        con.row_factory = sqlite3.Row
+        self._created_at[id(con)] = time.monotonic()
+        self._count('opened')
+        return con
+
+    def _count(self, stat):
+        with self._lock:
+            self._stats[stat] += 1
+
+    def _discard(self, con):
+        self._created_at.pop(id(con), None)
+        try:
+            con.close()
+        except sqlite3.Error:
+            pass
+        with self._lock:
+            self._size -= 1
+
+    def _is_healthy(self, con):
+        created = self._created_at.get(id(con), 0)
+        if time.monotonic() - created > self.recycle:
+            self._count('recycled')
+            return False
+        try:
+            con.execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            self._count('failed_health_checks')
+            return False
+
+    def checkout(self):
+        """Returns a healthy connection, opening one if the pool has room."""
+        started = time.monotonic()
+        waited = False
+        while True:
+            try:
+                con = self._idle.get_nowait()
+            except queue.Empty:
+                con = None
+                with self._lock:
+                    can_open = self._size < self.max_size
+                    if can_open:
+                        self._size += 1
+                if can_open:
+                    try:
+                        con = self._open()
+                    except Exception:
+                        with self._lock:
+                            self._size -= 1
+                        raise
+                else:
+                    waited = True
+                    remaining = self.timeout - (time.monotonic() - started)
+                    if remaining <= 0:
+                        self._count('timeouts')
+                        raise PoolTimeout(f"No database connection available after {self.timeout}s.")
+                    try:
+                        con = self._idle.get(timeout=remaining)
+                    except queue.Empty:
+                        continue
+            if con is not None and not self._is_healthy(con):
+                self._discard(con)
+                continue
+            break
+
+        elapsed = time.monotonic() - started
+        with self._lock:
+            stats = self._stats
+            stats['checkouts'] += 1
+            stats['checkout_time_total'] += elapsed
+            stats['checkout_time_max'] = max(stats['checkout_time_max'], elapsed)
+            if waited:
+                stats['waits'] += 1
+                stats['wait_time_total'] += elapsed
+                stats['wait_time_max'] = max(stats['wait_time_max'], elapsed)
+        return con
+
+    def release(self, con):
+        """Returns a connection to the pool, discarding it if it is no longer usable."""
+        try:
+            if con.in_transaction:
+                con.rollback()
+        except sqlite3.Error:
+            self._discard(con)
+            return
+        self._idle.put(con)
+
+    @contextmanager
+    def connection(self):
+        """Context manager that checks a connection out and always returns it."""
+        con = self.checkout()
+        try:
+            yield con
+        finally:
+            self.release(con)
+
+    def close(self):
+        """Closes all idle connections."""
+        while True:
+            try:
+                con = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(con)
+
+    def metrics(self):
+        """Returns a snapshot of the pool size, wait time and checkout latency."""
+        with self._lock:
+            stats = dict(self._stats)
+            size = self._size
+        checkouts = stats['checkouts'] or 1
+        waits = stats['waits'] or 1
+        idle = self._idle.qsize()
+        return {
+            'max_size': self.max_size,
+            'size': size,
+            'idle': idle,
+            'in_use': size - idle,
+            'checkouts': stats['checkouts'],
+            'opened': stats['opened'],
+            'recycled': stats['recycled'],
+            'failed_health_checks': stats['failed_health_checks'],
+            'timeouts': stats['timeouts'],
+            'waits': stats['waits'],
+            'wait_ms_avg': round(stats['wait_time_total'] / waits * 1000, 3),
+            'wait_ms_max': round(stats['wait_time_max'] * 1000, 3),
+            'checkout_ms_avg': round(stats['checkout_time_total'] / checkouts * 1000, 3),
+            'checkout_ms_max': round(stats['checkout_time_max'] * 1000, 3),
+        }
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_pool(password):
+    """Returns the process-wide connection pool for the given master password."""
+    if not password:
+        raise ValueError("A database password is required.")
+    with _pools_lock:
+        pool = _pools.get(password)
+        if pool is None:
+            pool = _pools[password] = ConnectionPool(password)
+        return pool
+
+def pool_metrics():
+    """Returns metrics for every pool opened in this process."""
+    with _pools_lock:
+        pools = list(_pools.values())
+    return [pool.metrics() for pool in pools]
+
+# --- Per-Request Query Counting ---
+COUNTED_STATEMENTS = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH', 'REPLACE')
+
+def _count_query(statement):
+    if has_app_context() and statement.lstrip()[:7].upper().startswith(COUNTED_STATEMENTS):
+        g._query_count = g.get('_query_count', 0) + 1
+
+def get_query_count():
+    """Returns how many statements the current request has run on its connection."""
+    return g.get('_query_count', 0)
+
 def get_db():
-    """Opens a new database connection for the Flask app context."""
+    """Checks out a pooled database connection for the Flask app context."""
     if not hasattr(g, '_database'):
         password = current_app.config.get('DB_PASSWORD')
         if not password:
             raise ValueError("Database password not found in app config.")
         try:
-            g._database = get_db_connection(password)
+            g._database = get_pool(password).checkout()
         except sqlite3.DatabaseError:
             g._database = None
             raise ValueError("Invalid master password.")
+        g._database.set_trace_callback(_count_query)
     return g._database
 
 def close_connection(exception):
-    """Closes the database connection at the end of the request."""
-    db = getattr(g, '_database', None)
+    """Returns the database connection to the pool at the end of the request."""
+    db = g.pop('_database', None)
     if db is not None:
-        db.close()
+        db.set_trace_callback(None)
+        get_pool(current_app.config.get('DB_PASSWORD')).release(db)
 
 def query_db(query, args=(), one=False):
     """Queries the database and returns a list of dictionaries."""
@@ -46,10 +311,37 @@ def query_db(query, args=(), one=False):
     cur.close()
     return rv[0] if rv and one else rv
 
+@contextmanager
+def transaction():
+    """
+    Groups a route's writes into one unit of work committed once at the end, or rolled
+    back on error. execute_db calls inside it don't commit on their own; nested uses
+    join the outer transaction.
+    """
+    db = get_db()
+    if g.get('_unit_of_work'):
+        yield db
+        return
+    if not db.in_transaction:
+        begin_immediate(db)
+    g._unit_of_work = True
+    try:
+        yield db
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        g._unit_of_work = False
+
 def execute_db(query, args=()):
     """Executes a database write operation within the Flask app context."""
     db = get_db()
+    if g.get('_unit_of_work'):
+        return db.execute(query, args)
     try:
+        if not db.in_transaction:
+            begin_immediate(db)
         cur = db.execute(query, args)
         db.commit()
         return cur
@@ -2,9 +2,15 @@ import imap_tools
 import re
 import os
 import sys
+import time
 import getpass
-from datetime import datetime
-from imap_tools import MailBox, A
+import argparse
+from datetime import datetime, timedelta
+from imap_tools import MailBox, A, U, MailMessageFlags
+from database import get_pool, configure_connection, begin_immediate, BUSY_TIMEOUT
+from ai_queue import enqueue_ticket_summary, enqueue_ticket_embedding
+from text_processing import normalize_body, compress_text
+from cache import cached_lookup, SETTINGS_CACHE_TTL
 
 try:
     from sqlcipher3 import dbapi2 as sqlite3
@@ -14,18 +20,35 @@ except ImportError:
 
 DB_FILE = "tickets.db"
 
+# Messages are committed and flagged as read in batches of this size.
+EMAIL_BATCH_SIZE = int(os.environ.get('EMAIL_BATCH_SIZE', 50))
+# Comma-separated IMAP folders synced in each pass; the first one is watched with IDLE.
+IMAP_FOLDERS = [f.strip() for f in os.environ.get('IMAP_FOLDERS', 'INBOX').split(',') if f.strip()]
+
+# Socket timeout for IMAP connections, so a hung server can't block a poll or the watcher forever.
+# IDLE waits set their own timeout and restore this one afterwards.
+IMAP_TIMEOUT = float(os.environ.get('IMAP_TIMEOUT', 60))
+
+# --- IDLE Watcher Settings ---
+# Servers may drop an IDLE after 30 minutes, so it is re-issued well before that.
+IDLE_TIMEOUT = int(os.environ.get('IMAP_IDLE_TIMEOUT', 300))
+RECONNECT_MIN_SECONDS = 5
+RECONNECT_MAX_SECONDS = 300
+WATCHER_JOB_NAME = 'Email Watcher (IDLE)'
+
 # Standalone DB connection function for scripts
 def get_script_db_connection(password):
     if not password: raise ValueError("A database password is required.")
-    con = sqlite3.connect(DB_FILE, timeout=10)
+    con = sqlite3.connect(DB_FILE, timeout=BUSY_TIMEOUT)
     con.execute(f"PRAGMA key = '{password}';")
     con.row_factory = sqlite3.Row
+    configure_connection(con)
     return con
 
-def get_creds_from_db(db_password):
-    """Reads credentials from the encrypted database."""
-    try:
-        with get_script_db_connection(db_password) as con:
+def get_creds_from_db(con):
+    """Reads credentials from the encrypted database, through the reference cache."""
+    def load():
+        try:
             cur = con.cursor()
             cur.execute("SELECT api_key, api_endpoint FROM api_keys WHERE service = 'imap'")
             creds = cur.fetchone()
@@ -33,81 +56,302 @@ def get_creds_from_db(db_password):
                 raise ValueError("IMAP credentials not found in the database.")
             imap_user, imap_password = creds['api_key'].split(":", 1)
             return creds['api_endpoint'], imap_user, imap_password
-    except sqlite3.Error as e:
-        sys.exit(f"Database error while fetching credentials: {e}. Is the password correct?")
+        except sqlite3.Error as e:
+            sys.exit(f"Database error while fetching credentials: {e}. Is the password correct?")
+    return cached_lookup('api_credentials', load, key='imap', ttl=SETTINGS_CACHE_TTL)
+
+def load_user_lookup(con):
+    """Preloads every user keyed by email so each message costs no lookup query."""
+    return {row['email']: dict(row) for row in con.execute("SELECT id, username, email, company_id FROM users")}
 
-def process_new_emails(db_password):
+def get_message_id(msg):
+    """Returns the Message-ID header of an email, or None if it has none."""
+    values = msg.headers.get('message-id') or ()
+    message_id = values[0].strip() if values else ''
+    return message_id or None
+
+def insert_reply(con, ticket_id, author_id, msg, message_id):
+    """
+    Stores an email as a reply. The reply row holds the normalized plain-text body;
+    the original body is kept compressed in reply_sources and attachments in reply_attachments.
+    """
+    content = normalize_body(msg.text, msg.html)
+    cur = con.execute("INSERT INTO ticket_replies (ticket_id, author_id, content, created_at, message_id) VALUES (?, ?, ?, ?, ?)",
+                      (ticket_id, author_id, content, msg.date.isoformat(), message_id))
+    reply_id = cur.lastrowid
+    original, content_type = (msg.html, 'text/html') if msg.html else (msg.text, 'text/plain')
+    if original and original != content:
+        con.execute("INSERT INTO reply_sources (reply_id, content_type, body, raw_size) VALUES (?, ?, ?, ?)",
+                    (reply_id, content_type, compress_text(original), len(original)))
+    for att in msg.attachments:
+        con.execute("INSERT INTO reply_attachments (reply_id, filename, content_type, size, data) VALUES (?, ?, ?, ?, ?)",
+                    (reply_id, att.filename or 'attachment', att.content_type or 'application/octet-stream', len(att.payload), att.payload))
+    return reply_id
+
+def ingest_message(con, msg, users, unknown_company_id):
+    """
+    Creates or updates the ticket for one email on an open transaction, without committing.
+    Returns False if an email with the same Message-ID was already ingested.
+    """
+    message_id = get_message_id(msg)
+    if message_id and con.execute("SELECT 1 FROM ticket_replies WHERE message_id = ?", (message_id,)).fetchone():
+        print(f"\n[*] Skipping already ingested email {message_id}.")
+        return False
+
+    print("\n--- NEW EMAIL FOUND ---")
+    print(f"  From:    {msg.from_}")
+    print(f"  Subject: {msg.subject}")
+    print(f"  Date:    {msg.date_str}")
+    print("-----------------------")
+
+    ticket_id_match = re.search(r'\[Ticket #(\d+)\]', msg.subject)
+
+    # Find or create the user and company
+    user_email = msg.from_
+    user = users.get(user_email)
+    if not user:
+        # User doesn't exist, create them in the "Unknown" company
+        # *** BUG FIX HERE ***
+        # Provide a non-null, unusable password hash for new client users.
+        placeholder_hash = '<no-password-set>'
+        cur = con.execute("INSERT INTO users (username, email, company_id, role, password_hash) VALUES (?, ?, ?, ?, ?)",
+                          (user_email, user_email, unknown_company_id, 'Client', placeholder_hash))
+        user = users[user_email] = {'id': cur.lastrowid, 'username': user_email, 'email': user_email, 'company_id': unknown_company_id}
+        print(f"  -> Created new user '{user_email}' in 'Unknown' company.")
+
+    if ticket_id_match:
+        ticket_id = int(ticket_id_match.group(1))
+        insert_reply(con, ticket_id, user['id'], msg, message_id)
+        # The thread changed, so any stored summary is stale.
+        con.execute("UPDATE tickets SET updated_at = ?, summary = NULL WHERE id = ?",
+                   (datetime.now().isoformat(), ticket_id))
+        enqueue_ticket_summary(con, ticket_id)
+        enqueue_ticket_embedding(con, ticket_id)
+        print(f"  -> Added reply to ticket #{ticket_id} from user {user['username']}")
+    else:
+        now = datetime.now().isoformat()
+        cur = con.execute("INSERT INTO tickets (subject, created_at, updated_at, company_id, user_id) VALUES (?, ?, ?, ?, ?)",
+                          (msg.subject, now, now, user['company_id'], user['id']))
+        new_ticket_id = cur.lastrowid
+        insert_reply(con, new_ticket_id, user['id'], msg, message_id)
+        new_subject = f"[Ticket #{new_ticket_id}] {msg.subject}"
+        con.execute("UPDATE tickets SET subject = ? WHERE id = ?", (new_subject, new_ticket_id))
+        enqueue_ticket_summary(con, new_ticket_id)
+        enqueue_ticket_embedding(con, new_ticket_id)
+        print(f"  -> Created new ticket #{new_ticket_id} for user {user['username']} in company ID {user['company_id']}")
+    return True
+
+def save_checkpoint(con, account, folder, uidvalidity, last_uid):
+    con.execute("INSERT OR REPLACE INTO imap_sync_state (account, folder, uidvalidity, last_uid, updated_at) VALUES (?, ?, ?, ?, ?)",
+                (account, folder, uidvalidity, last_uid, datetime.now().isoformat(timespec='seconds')))
+
+def sync_folder(mailbox, con, account, folder, users, unknown_company_id, batch_size=EMAIL_BATCH_SIZE):
+    """
+    Ingests the emails in one folder that arrived after its stored UID checkpoint.
+    Each batch commits its tickets together with the advanced checkpoint, so a crash
+    either keeps both or neither; the messages are flagged read only afterwards.
+    The checkpoint only ever covers messages that were committed. Returns the number
+    of emails ingested.
+    """
+    mailbox.folder.set(folder)
+    status = mailbox.folder.status(folder, ['UIDVALIDITY', 'UIDNEXT'])
+    uidvalidity = status['UIDVALIDITY']
+    state = con.execute("SELECT uidvalidity, last_uid FROM imap_sync_state WHERE account = ? AND folder = ?", (account, folder)).fetchone()
+    first_sync = not state or state['uidvalidity'] != uidvalidity
+    if not first_sync:
+        last_uid = state['last_uid']
+        criteria = A(uid=U(last_uid + 1, '*'))
+    else:
+        # First sync of this folder, or the server renumbered it: take the unread mail.
+        # No checkpoint is stored until all of it is committed, so an interrupted first
+        # sync starts over from the mail still unread. Message-ID deduplication guards
+        # against repeats.
+        if state:
+            print(f"[!] UIDVALIDITY of '{folder}' changed; resynchronizing from unread mail.")
+        last_uid = 0
+        criteria = A(seen=False)
+    checkpoint = last_uid
+
+    processed = 0
+    pending = []
+
+    def commit_batch():
+        nonlocal processed, checkpoint
+        # Messages are fetched before the write transaction starts, so the database
+        # write lock is held only while the batch is written, never across IMAP round trips.
+        begin_immediate(con)
+        failed = set()
+        for msg in pending:
+            # One bad message must not block the folder: its writes are undone on its
+            # own, it stays unread on the server, and the checkpoint moves past it.
+            con.execute("SAVEPOINT ingest_message")
+            try:
+                if ingest_message(con, msg, users, unknown_company_id):
+                    processed += 1
+                con.execute("RELEASE SAVEPOINT ingest_message")
+            except Exception as e:
+                con.execute("ROLLBACK TO SAVEPOINT ingest_message")
+                con.execute("RELEASE SAVEPOINT ingest_message")
+                failed.add(msg.uid)
+                # The lookup may hold a user whose insert was just rolled back.
+                users.clear()
+                users.update(load_user_lookup(con))
+                print(f"[!] Could not ingest email UID {msg.uid} {get_message_id(msg) or ''} from '{folder}': {e}. "
+                      "Skipping it; it is left unread.", file=sys.stderr)
+            checkpoint = max(checkpoint, int(msg.uid))
+        if not first_sync:
+            save_checkpoint(con, account, folder, uidvalidity, checkpoint)
+        con.commit()
+        ingested = [msg.uid for msg in pending if msg.uid not in failed]
+        if ingested:
+            mailbox.flag(ingested, MailMessageFlags.SEEN, True)
+        if pending:
+            print(f"[*] Committed a batch of {len(pending)} email(s) from '{folder}' (checkpoint UID {checkpoint}).")
+            pending.clear()
+
+    try:
+        for msg in mailbox.fetch(criteria, mark_seen=False, bulk=batch_size):
+            # 'UID n:*' always matches the newest message, even when it is older than n.
+            if int(msg.uid) <= last_uid:
+                continue
+            pending.append(msg)
+            if len(pending) >= batch_size:
+                commit_batch()
+        commit_batch()
+        if first_sync:
+            # Everything unread is in; older read mail is skipped from now on.
+            checkpoint = max(checkpoint, status.get('UIDNEXT', 1) - 1)
+            save_checkpoint(con, account, folder, uidvalidity, checkpoint)
+            con.commit()
+    except Exception:
+        con.rollback()
+        raise
+    return processed
+
+def sync_mailbox(mailbox, con, account, folders=None, batch_size=EMAIL_BATCH_SIZE):
+    """Incrementally syncs every configured folder on a logged-in mailbox. Returns the number of emails ingested."""
+    unknown_company = con.execute("SELECT id FROM companies WHERE name = 'Unknown'").fetchone()
+    if not unknown_company:
+        # This should not happen if init_db.py is run correctly
+        sys.exit("FATAL: 'Unknown' company not found in the database.")
+    users = load_user_lookup(con)
+
+    processed = 0
+    for folder in folders or IMAP_FOLDERS:
+        processed += sync_folder(mailbox, con, account, folder, users, unknown_company['id'], batch_size=batch_size)
+
+    if processed:
+        print(f"\n[*] Email processing complete. {processed} new email(s) were ingested.")
+    else:
+        print("\n[+] No new emails found.")
+    return processed
+
+def poll_mailbox(con, batch_size=EMAIL_BATCH_SIZE, folders=None):
     """
     Connects to the mailbox, fetches unread emails, and creates or updates tickets.
+    Returns the number of emails ingested. Connection and login errors are raised so
+    the scheduler records the run as failed.
     """
-    imap_server, imap_user, imap_password = get_creds_from_db(db_password)
+    if watcher_is_active(con):
+        print("[*] The IDLE watcher is running and handles new mail. Skipping this poll.")
+        return 0
+    imap_server, imap_user, imap_password = get_creds_from_db(con)
     print(f"[*] Connecting to mailbox for {imap_user}...")
 
     try:
-        with MailBox(imap_server).login(imap_user, imap_password) as mailbox:
-            found_emails = False
-            for msg in mailbox.fetch(A(seen=False), limit=10):
-                found_emails = True
-                print("\n--- NEW EMAIL FOUND ---")
-                print(f"  From:    {msg.from_}")
-                print(f"  Subject: {msg.subject}")
-                print(f"  Date:    {msg.date_str}")
-                print("-----------------------")
-
-                ticket_id_match = re.search(r'\[Ticket #(\d+)\]', msg.subject)
-
-                with get_script_db_connection(db_password) as con:
-                    # Find or create the user and company
-                    user_email = msg.from_
-                    user = con.execute("SELECT * FROM users WHERE email = ?", (user_email,)).fetchone()
-                    if not user:
-                        # User doesn't exist, create them in the "Unknown" company
-                        unknown_company = con.execute("SELECT id FROM companies WHERE name = 'Unknown'").fetchone()
-                        if not unknown_company:
-                            # This should not happen if init_db.py is run correctly
-                            sys.exit("FATAL: 'Unknown' company not found in the database.")
-                        
-                        cur = con.cursor()
-                        # *** BUG FIX HERE ***
-                        # Provide a non-null, unusable password hash for new client users.
-                        placeholder_hash = '<no-password-set>'
-                        cur.execute("INSERT INTO users (username, email, company_id, role, password_hash) VALUES (?, ?, ?, ?, ?)",
-                                     (user_email, user_email, unknown_company['id'], 'Client', placeholder_hash))
-                        user_id = cur.lastrowid
-                        con.commit()
-                        user = con.execute("SELECT * FROM users WHERE id = ?", (user_id,)).fetchone()
-                        print(f"  -> Created new user '{user_email}' in 'Unknown' company.")
-
-                    if ticket_id_match:
-                        ticket_id = int(ticket_id_match.group(1))
-                        con.execute("INSERT INTO ticket_replies (ticket_id, author_id, content, created_at) VALUES (?, ?, ?, ?)",
-                                   (ticket_id, user['id'], msg.text or msg.html, msg.date.isoformat()))
-                        con.commit()
-                        print(f"  -> Added reply to ticket #{ticket_id} from user {user['username']}")
-                    else:
-                        now = datetime.now().isoformat()
-                        cur = con.cursor()
-                        cur.execute("INSERT INTO tickets (subject, created_at, updated_at, company_id, user_id) VALUES (?, ?, ?, ?, ?)",
-                                     (msg.subject, now, now, user['company_id'], user['id']))
-                        new_ticket_id = cur.lastrowid
-                        con.execute("INSERT INTO ticket_replies (ticket_id, author_id, content, created_at) VALUES (?, ?, ?, ?)",
-                                   (new_ticket_id, user['id'], msg.text or msg.html, msg.date.isoformat()))
-                        new_subject = f"[Ticket #{new_ticket_id}] {msg.subject}"
-                        con.execute("UPDATE tickets SET subject = ? WHERE id = ?", (new_subject, new_ticket_id))
-                        con.commit()
-                        print(f"  -> Created new ticket #{new_ticket_id} for user {user['username']} in company ID {user['company_id']}")
-
-
-            if found_emails:
-                print("\n[*] Email processing complete. Found emails were marked as read.")
-            else:
-                print("\n[+] No unread emails found.")
-
+        with MailBox(imap_server, timeout=IMAP_TIMEOUT).login(imap_user, imap_password) as mailbox:
+            return sync_mailbox(mailbox, con, f"{imap_user}@{imap_server}", folders, batch_size=batch_size)
     except Exception as e:
-        print(f"\n[!] An error occurred during email processing: {e}")
+        print(f"\n[!] An error occurred during email processing: {e}", file=sys.stderr)
+        raise
+
+def process_new_emails(db_password, batch_size=EMAIL_BATCH_SIZE, folders=None):
+    """Polls the mailbox once on a connection of its own, as the standalone script does."""
+    con = get_script_db_connection(db_password)
+    try:
+        poll_mailbox(con, batch_size=batch_size, folders=folders)
+    except Exception:
+        # Already reported; a non-zero exit marks the subprocess run as failed.
+        sys.exit(1)
+    finally:
+        con.close()
+
+def run(db_password):
+    """
+    Entry point for the scheduler's in-process mode: one poll on a pooled connection.
+    Returns the number of emails ingested, which is recorded with the run.
+    """
+    with get_pool(db_password).connection() as con:
+        return poll_mailbox(con)
+
+# --- Resident IDLE Watcher ---
+def report_watcher_status(con, status, message):
+    """Records the IDLE watcher's state and heartbeat in its own scheduler_jobs row."""
+    # The row is disabled so the scheduler lists it without ever launching it.
+    con.execute("INSERT OR IGNORE INTO scheduler_jobs (job_name, script_path, interval_minutes, enabled) VALUES (?, ?, ?, ?)",
+                (WATCHER_JOB_NAME, 'email_watcher.py --watch', 0, 0))
+    con.execute("UPDATE scheduler_jobs SET last_run = ?, last_status = ?, last_run_log = ? WHERE job_name = ?",
+                (datetime.now().isoformat(timespec='seconds'), status, message, WATCHER_JOB_NAME))
+    con.commit()
+
+def watcher_is_active(con):
+    """True if an IDLE watcher has sent a heartbeat recently enough to still be connected."""
+    row = con.execute("SELECT last_run, last_status FROM scheduler_jobs WHERE job_name = ?", (WATCHER_JOB_NAME,)).fetchone()
+    if not row or row['last_status'] != 'Watching' or not row['last_run']:
+        return False
+    stale_after = timedelta(seconds=2 * IDLE_TIMEOUT + 60)
+    return datetime.now() - datetime.fromisoformat(row['last_run']) < stale_after
+
+def watch_mailbox(db_password, batch_size=EMAIL_BATCH_SIZE, folders=None):
+    """
+    Keeps one authenticated IMAP connection open and ingests mail as soon as the
+    server pushes a change through IDLE. Reconnects with exponential backoff.
+    """
+    con = get_script_db_connection(db_password)
+    imap_server, imap_user, imap_password = get_creds_from_db(con)
+    account = f"{imap_user}@{imap_server}"
+    folders = folders or IMAP_FOLDERS
+    backoff = RECONNECT_MIN_SECONDS
+    try:
+        while True:
+            try:
+                print(f"[*] Connecting to mailbox for {imap_user} (IDLE mode)...")
+                with MailBox(imap_server, timeout=IMAP_TIMEOUT).login(imap_user, imap_password) as mailbox:
+                    backoff = RECONNECT_MIN_SECONDS
+                    report_watcher_status(con, 'Watching', f"Connected as {imap_user} at {datetime.now().isoformat(timespec='seconds')}.")
+                    # Catch up on anything that arrived while we were disconnected.
+                    sync_mailbox(mailbox, con, account, folders, batch_size=batch_size)
+                    while True:
+                        # IDLE only reports changes in the selected folder, so the other
+                        # folders are synced on every wake-up and IDLE timeout.
+                        mailbox.folder.set(folders[0])
+                        mailbox.idle.wait(timeout=IDLE_TIMEOUT)
+                        sync_mailbox(mailbox, con, account, folders, batch_size=batch_size)
+                        report_watcher_status(con, 'Watching', f"Connected as {imap_user}. Last IDLE cycle at {datetime.now().isoformat(timespec='seconds')}.")
+            except KeyboardInterrupt:
+                raise
+            except Exception as e:
+                print(f"\n[!] IDLE watcher lost its connection: {e}. Reconnecting in {backoff}s.", file=sys.stderr)
+                try:
+                    report_watcher_status(con, 'Reconnecting', f"{e} (retrying in {backoff}s)")
+                except Exception:
+                    pass
+                time.sleep(backoff)
+                backoff = min(backoff * 2, RECONNECT_MAX_SECONDS)
+    except KeyboardInterrupt:
+        print("\n[*] IDLE watcher stopped.")
+        report_watcher_status(con, 'Stopped', f"Stopped at {datetime.now().isoformat(timespec='seconds')}.")
+    finally:
+        con.close()
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Turn incoming email into tickets.")
+    parser.add_argument('--watch', action='store_true', help="stay connected and ingest mail as it arrives using IMAP IDLE")
+    parser.add_argument('--batch-size', type=int, default=EMAIL_BATCH_SIZE, help="emails committed per transaction")
+    parser.add_argument('--folders', help="comma-separated IMAP folders to sync (default: IMAP_FOLDERS or INBOX)")
+    args = parser.parse_args()
+
     DB_MASTER_PASSWORD = os.environ.get('DB_MASTER_PASSWORD')
     if not DB_MASTER_PASSWORD:
         try:
@@ -116,4 +360,8 @@ if __name__ == "__main__":
              DB_MASTER_PASSWORD = input("Please enter the database password: ")
     if not DB_MASTER_PASSWORD:
         sys.exit("FATAL: No database password provided. Aborting.")
-    process_new_emails(DB_MASTER_PASSWORD)
+    folders = [f.strip() for f in args.folders.split(',') if f.strip()] if args.folders else None
+    if args.watch:
+        watch_mailbox(DB_MASTER_PASSWORD, batch_size=args.batch_size, folders=folders)
+    else:
+        process_new_emails(DB_MASTER_PASSWORD, batch_size=args.batch_size, folders=folders)
@@ -0,0 +1,263 @@
+import os
+import re
+import sys
+import zlib
+import atexit
+import threading
+from datetime import datetime
+from database import DATABASE
+from ai_processing import get_client, get_endpoint, OllamaError
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# --- Embedding Settings ---
+# 'ollama' uses the Ollama embeddings API; 'local' uses a hashing embedder that needs no server.
+EMBEDDING_BACKEND = os.environ.get('EMBEDDING_BACKEND', 'ollama')
+EMBEDDING_MODEL = os.environ.get('EMBEDDING_MODEL', 'nomic-embed-text')
+LOCAL_EMBEDDING_DIM = 512
+# The index is stored as NumPy arrays in a directory next to the database file.
+# Only one process may write it: the first to open the index takes a lock file in the
+# directory, and any other process (another web worker, or `python embeddings.py` while
+# the web app runs) searches its own copy without saving.
+INDEX_DIR = os.environ.get('EMBEDDING_INDEX_DIR', f"{DATABASE}.embeddings")
+INDEX_SAVE_INTERVAL = float(os.environ.get('EMBEDDING_SAVE_INTERVAL', 30))
+CHAT_CONTEXT_SNIPPETS = int(os.environ.get('CHAT_CONTEXT_SNIPPETS', 5))
+SNIPPET_CHARS = 800
+# Long replies are embedded from their opening text only.
+EMBED_MAX_CHARS = 4000
+
+def embeddings_available():
+    return np is not None
+
+class HashingEmbedder:
+    """A deterministic local stand-in for a real embedding model, based on feature hashing."""
+
+    def __init__(self, dim=LOCAL_EMBEDDING_DIM):
+        self.dim = dim
+
+    def embed(self, text):
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for token in re.findall(r'\w+', text.lower()):
+            bucket = zlib.crc32(token.encode('utf-8'))
+            vector[bucket % self.dim] += 1.0 if bucket & 0x80000000 else -1.0
+        return vector
+
+class OllamaEmbedder:
+    """Embeds text through the Ollama embeddings API using the shared client."""
+
+    def __init__(self, model=EMBEDDING_MODEL):
+        self.model = model
+
+    def embed(self, text):
+        endpoint = get_endpoint()
+        if not endpoint:
+            raise OllamaError("Ollama endpoint not configured.")
+        return np.asarray(get_client().embed(endpoint, text, self.model), dtype=np.float32)
+
+def get_embedder():
+    return HashingEmbedder() if EMBEDDING_BACKEND == 'local' else OllamaEmbedder()
+
+def normalize(vector):
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+class EmbeddingIndex:
+    """
+    Reply embeddings held in memory as one normalized float32 matrix, with parallel
+    arrays of reply and ticket ids. Similarity search is a single matrix-vector product.
+    """
+
+    def __init__(self, directory=INDEX_DIR):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self.vectors = None
+        self.reply_ids = np.zeros(0, dtype=np.int64)
+        self.ticket_ids = np.zeros(0, dtype=np.int64)
+        self._pending = []
+        self._dirty = False
+        self._saved_at = 0.0
+        self._writer_file = None
+        # Locked before loading, so the writer starts from everything saved before it.
+        self.writable = self._acquire_writer_lock()
+        self.load()
+
+    def _path(self, name):
+        return os.path.join(self.directory, f"{name}.npy")
+
+    def _acquire_writer_lock(self):
+        """Takes the directory's writer lock for the life of the process. Returns False if another process holds it."""
+        if fcntl is None:
+            return True
+        os.makedirs(self.directory, exist_ok=True)
+        lock_file = open(os.path.join(self.directory, 'writer.lock'), 'w')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            print(f"[!] Another process is writing the embedding index in '{self.directory}'; "
+                  "this one will search it but not save its additions.", file=sys.stderr)
+            return False
+        self._writer_file = lock_file
+        return True
+
+    def load(self):
+        if not os.path.exists(self._path('vectors')):
+            return
+        with self._lock:
+            self.vectors = np.load(self._path('vectors'))
+            self.reply_ids = np.load(self._path('reply_ids'))
+            self.ticket_ids = np.load(self._path('ticket_ids'))
+
+    def _consolidate(self):
+        """Merges pending additions into the main arrays. Caller holds the lock."""
+        if not self._pending:
+            return
+        new_replies = np.array([p[0] for p in self._pending], dtype=np.int64)
+        new_tickets = np.array([p[1] for p in self._pending], dtype=np.int64)
+        new_vectors = np.vstack([p[2] for p in self._pending])
+        self._pending = []
+        if self.vectors is not None and len(self.reply_ids):
+            # Re-embedded replies replace their old rows.
+            keep = ~np.isin(self.reply_ids, new_replies)
+            self.vectors = np.vstack([self.vectors[keep], new_vectors])
+            self.reply_ids = np.concatenate([self.reply_ids[keep], new_replies])
+            self.ticket_ids = np.concatenate([self.ticket_ids[keep], new_tickets])
+        else:
+            self.vectors, self.reply_ids, self.ticket_ids = new_vectors, new_replies, new_tickets
+
+    def add(self, reply_id, ticket_id, vector):
+        with self._lock:
+            self._pending.append((reply_id, ticket_id, normalize(np.asarray(vector, dtype=np.float32))))
+            self._dirty = True
+
+    def indexed_reply_ids(self):
+        with self._lock:
+            self._consolidate()
+            return set(self.reply_ids.tolist())
+
+    def search(self, query_vector, k=CHAT_CONTEXT_SNIPPETS, exclude_ticket_id=None, ticket_ids=None):
+        """
+        Returns up to k (reply_id, ticket_id, score) tuples, most similar first.
+        If ticket_ids is given, only replies on those tickets can match.
+        """
+        with self._lock:
+            self._consolidate()
+            if self.vectors is None or not len(self.reply_ids):
+                return []
+            if self.vectors.shape[1] != len(query_vector):
+                return []
+            scores = self.vectors @ normalize(np.asarray(query_vector, dtype=np.float32))
+            if exclude_ticket_id is not None:
+                # The ticket's own thread is already in the prompt.
+                scores[self.ticket_ids == exclude_ticket_id] = -np.inf
+            if ticket_ids is not None:
+                scores[~np.isin(self.ticket_ids, np.asarray(ticket_ids, dtype=np.int64))] = -np.inf
+            k = min(k, int(np.isfinite(scores).sum()))
+            if k == 0:
+                return []
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            return [(int(self.reply_ids[i]), int(self.ticket_ids[i]), float(scores[i])) for i in top]
+
+    def save(self, force=False):
+        """Writes the arrays atomically, at most once per INDEX_SAVE_INTERVAL unless forced."""
+        now = datetime.now().timestamp()
+        with self._lock:
+            if not self.writable or not self._dirty or (not force and now - self._saved_at < INDEX_SAVE_INTERVAL):
+                return
+            self._consolidate()
+            os.makedirs(self.directory, exist_ok=True)
+            for name, array in (('vectors', self.vectors), ('reply_ids', self.reply_ids), ('ticket_ids', self.ticket_ids)):
+                tmp_path = self._path(name) + '.tmp'
+                with open(tmp_path, 'wb') as f:
+                    np.save(f, array)
+                os.replace(tmp_path, self._path(name))
+            self._dirty = False
+            self._saved_at = now
+
+    def __len__(self):
+        with self._lock:
+            return len(self.reply_ids) + len(self._pending)
+
+_index = None
+_index_lock = threading.Lock()
+
+def get_index():
+    """
+    Returns the process-wide embedding index, or None if NumPy is not installed. Saves
+    between INDEX_SAVE_INTERVAL are skipped, so the index is saved once more at exit.
+    """
+    global _index
+    if not embeddings_available():
+        return None
+    with _index_lock:
+        if _index is None:
+            _index = EmbeddingIndex()
+            atexit.register(_index.save, force=True)
+        return _index
+
+def index_replies(con, ticket_id=None):
+    """Embeds replies (of one ticket, or all) that are not in the index yet. Returns how many were added."""
+    index = get_index()
+    if index is None:
+        return 0
+    if ticket_id is None:
+        rows = con.execute("SELECT id, ticket_id, content FROM ticket_replies ORDER BY id")
+    else:
+        rows = con.execute("SELECT id, ticket_id, content FROM ticket_replies WHERE ticket_id = ? ORDER BY id", (ticket_id,))
+    known = index.indexed_reply_ids()
+    embedder = get_embedder()
+    added = 0
+    for row in rows.fetchall():
+        if row['id'] in known or not row['content']:
+            continue
+        index.add(row['id'], row['ticket_id'], embedder.embed(row['content'][:EMBED_MAX_CHARS]))
+        added += 1
+    index.save()
+    return added
+
+def retrieve_snippets(con, question, company_id, k=CHAT_CONTEXT_SNIPPETS, exclude_ticket_id=None):
+    """
+    Returns the k replies most similar to the question, from tickets of the given
+    company only, as formatted snippets, or None when there is no index to search.
+    """
+    index = get_index()
+    if index is None or not len(index):
+        return None
+    # Tickets can move between companies, so the scope is read from the DB, not the index.
+    company_tickets = [row['id'] for row in con.execute("SELECT id FROM tickets WHERE company_id IS ?", (company_id,))]
+    matches = index.search(get_embedder().embed(question), k=k, exclude_ticket_id=exclude_ticket_id, ticket_ids=company_tickets)
+    if not matches:
+        return None
+    reply_ids = [reply_id for reply_id, _, _ in matches]
+    placeholders = ','.join('?' * len(reply_ids))
+    rows = {row['id']: row for row in con.execute(f"""
+        SELECT r.id, r.ticket_id, substr(r.content, 1, {SNIPPET_CHARS}) AS snippet
+        FROM ticket_replies r JOIN tickets t ON t.id = r.ticket_id
+        WHERE r.id IN ({placeholders}) AND t.company_id IS ?
+    """, (*reply_ids, company_id))}
+    return [f"[Ticket #{rows[reply_id]['ticket_id']}] {rows[reply_id]['snippet']}" for reply_id in reply_ids if reply_id in rows]
+
+if __name__ == "__main__":
+    from database import get_db_connection
+    if not embeddings_available():
+        sys.exit("FATAL: NumPy is not installed. Please install it using: pip install numpy")
+    DB_MASTER_PASSWORD = os.environ.get('DB_MASTER_PASSWORD')
+    if not DB_MASTER_PASSWORD:
+        sys.exit("FATAL: DB_MASTER_PASSWORD environment variable not set.")
+    if not get_index().writable:
+        sys.exit("FATAL: The embedding index is locked by another process (usually the web app). Stop it and try again.")
+    con = get_db_connection(DB_MASTER_PASSWORD)
+    print(f"[*] Embedding replies missing from '{INDEX_DIR}' with the {EMBEDDING_BACKEND} backend...")
+    added = index_replies(con)
+    get_index().save(force=True)
+    con.close()
+    print(f"[*] Added {added} replies. The index now holds {len(get_index())} replies.")
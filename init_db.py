@@ -5,6 +5,7 @@ import time
 import shutil
 from werkzeug.security import generate_password_hash
 from datetime import datetime
+from text_processing import normalize_body, looks_like_html, compress_text
 
 try:
     from sqlcipher3 import dbapi2 as sqlite3
@@ -15,6 +16,255 @@ except ImportError:
 
 DB_FILE = "tickets.db"
 
+# (FTS5 index table, source table, indexed column)
+SEARCH_TABLES = [
+    ('search_tickets', 'tickets', 'subject'),
+    ('search_replies', 'ticket_replies', 'content'),
+    ('search_company_notes', 'company_notes', 'content'),
+    ('search_user_notes', 'user_notes', 'content'),
+]
+
+def normalize_existing_replies(con, batch_size=500):
+    """Moves raw email bodies already in ticket_replies into reply_sources and keeps normalized text in place."""
+    last_id = 0
+    moved = 0
+    while True:
+        rows = con.execute("SELECT id, content FROM ticket_replies WHERE id > ? ORDER BY id LIMIT ?", (last_id, batch_size)).fetchall()
+        if not rows:
+            break
+        for reply_id, content in rows:
+            normalized = normalize_body(content)
+            if normalized != content:
+                content_type = 'text/html' if looks_like_html(content) else 'text/plain'
+                con.execute("INSERT OR IGNORE INTO reply_sources (reply_id, content_type, body, raw_size) VALUES (?, ?, ?, ?)",
+                            (reply_id, content_type, compress_text(content), len(content)))
+                con.execute("UPDATE ticket_replies SET content = ? WHERE id = ?", (normalized, reply_id))
+                moved += 1
+        last_id = rows[-1][0]
+    print(f"[*] Normalized {moved} existing reply bodies.")
+
+# --- Schema Migrations ---
+# Each migration is (version, description, statements). Versions are applied in order
+# and recorded in the schema_migrations table; never edit one that has shipped.
+MIGRATIONS = [
+    (1, "Secondary indexes for ticket lists, replies and notes", [
+        "CREATE INDEX IF NOT EXISTS idx_tickets_updated ON tickets (updated_at DESC, id DESC)",
+        "CREATE INDEX IF NOT EXISTS idx_tickets_company ON tickets (company_id, updated_at DESC)",
+        "CREATE INDEX IF NOT EXISTS idx_tickets_user ON tickets (user_id, updated_at DESC)",
+        "CREATE INDEX IF NOT EXISTS idx_tickets_assigned ON tickets (assigned_to_id, updated_at DESC)",
+        "CREATE INDEX IF NOT EXISTS idx_ticket_replies_ticket ON ticket_replies (ticket_id, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_users_company ON users (company_id, username)",
+        "CREATE INDEX IF NOT EXISTS idx_company_notes_company ON company_notes (company_id, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_user_notes_user ON user_notes (user_id, created_at)",
+    ]),
+    (2, "Keyset pagination indexes and cached ticket counters", [
+        "CREATE INDEX IF NOT EXISTS idx_tickets_created ON tickets (created_at DESC, id DESC)",
+        "CREATE INDEX IF NOT EXISTS idx_tickets_status ON tickets (status, updated_at DESC)",
+        "CREATE INDEX IF NOT EXISTS idx_tickets_priority ON tickets (priority, updated_at DESC)",
+        "CREATE TABLE IF NOT EXISTS ticket_counters (status TEXT PRIMARY KEY, total INTEGER NOT NULL DEFAULT 0)",
+        "INSERT OR REPLACE INTO ticket_counters (status, total) SELECT status, COUNT(*) FROM tickets GROUP BY status",
+        """CREATE TRIGGER IF NOT EXISTS trg_ticket_counters_insert AFTER INSERT ON tickets BEGIN
+            INSERT OR IGNORE INTO ticket_counters (status, total) VALUES (NEW.status, 0);
+            UPDATE ticket_counters SET total = total + 1 WHERE status = NEW.status;
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_ticket_counters_delete AFTER DELETE ON tickets BEGIN
+            UPDATE ticket_counters SET total = total - 1 WHERE status = OLD.status;
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_ticket_counters_status AFTER UPDATE OF status ON tickets
+        WHEN OLD.status IS NOT NEW.status BEGIN
+            UPDATE ticket_counters SET total = total - 1 WHERE status = OLD.status;
+            INSERT OR IGNORE INTO ticket_counters (status, total) VALUES (NEW.status, 0);
+            UPDATE ticket_counters SET total = total + 1 WHERE status = NEW.status;
+        END""",
+    ]),
+    (3, "Content-addressed cache for AI results", [
+        """CREATE TABLE IF NOT EXISTS ai_cache (
+            cache_key TEXT PRIMARY KEY, operation TEXT NOT NULL, model TEXT NOT NULL, result TEXT NOT NULL,
+            created_at TEXT NOT NULL, last_used_at TEXT NOT NULL
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_ai_cache_last_used ON ai_cache (last_used_at)",
+    ]),
+    (4, "Persistent AI job queue", [
+        """CREATE TABLE IF NOT EXISTS ai_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, operation TEXT NOT NULL, priority INTEGER NOT NULL DEFAULT 5,
+            status TEXT NOT NULL DEFAULT 'queued' CHECK (status IN ('queued', 'running', 'done', 'failed')),
+            ticket_id INTEGER, payload TEXT NOT NULL, result TEXT, error TEXT, attempts INTEGER NOT NULL DEFAULT 0,
+            created_at TEXT NOT NULL, started_at TEXT, finished_at TEXT,
+            FOREIGN KEY (ticket_id) REFERENCES tickets (id) ON DELETE CASCADE
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_ai_jobs_status ON ai_jobs (status, priority, id)",
+        "CREATE INDEX IF NOT EXISTS idx_ai_jobs_finished ON ai_jobs (finished_at)",
+    ]),
+    (5, "Debounced AI jobs for automatic ticket summaries", [
+        "ALTER TABLE ai_jobs ADD COLUMN dedupe_key TEXT",
+        "ALTER TABLE ai_jobs ADD COLUMN not_before TEXT",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_ai_jobs_dedupe ON ai_jobs (dedupe_key) WHERE status = 'queued'",
+    ]),
+    (6, "IMAP UID checkpoints and Message-ID deduplication", [
+        """CREATE TABLE IF NOT EXISTS imap_sync_state (
+            account TEXT NOT NULL, folder TEXT NOT NULL, uidvalidity INTEGER NOT NULL, last_uid INTEGER NOT NULL,
+            updated_at TEXT NOT NULL, PRIMARY KEY (account, folder)
+        )""",
+        "ALTER TABLE ticket_replies ADD COLUMN message_id TEXT",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_ticket_replies_message_id ON ticket_replies (message_id) WHERE message_id IS NOT NULL",
+    ]),
+    (7, "Full-text search over tickets, replies and notes", [
+        statement
+        for index_table, source_table, column in SEARCH_TABLES
+        for statement in (
+            # External-content tables index the source rows without storing a second copy of the text.
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {index_table} USING fts5({column}, content='{source_table}', content_rowid='id', tokenize='porter unicode61')",
+            f"""CREATE TRIGGER IF NOT EXISTS trg_{index_table}_insert AFTER INSERT ON {source_table} BEGIN
+                INSERT INTO {index_table} (rowid, {column}) VALUES (NEW.id, NEW.{column});
+            END""",
+            f"""CREATE TRIGGER IF NOT EXISTS trg_{index_table}_delete AFTER DELETE ON {source_table} BEGIN
+                INSERT INTO {index_table} ({index_table}, rowid, {column}) VALUES ('delete', OLD.id, OLD.{column});
+            END""",
+            f"""CREATE TRIGGER IF NOT EXISTS trg_{index_table}_update AFTER UPDATE OF {column} ON {source_table} BEGIN
+                INSERT INTO {index_table} ({index_table}, rowid, {column}) VALUES ('delete', OLD.id, OLD.{column});
+                INSERT INTO {index_table} (rowid, {column}) VALUES (NEW.id, NEW.{column});
+            END""",
+            f"INSERT INTO {index_table} ({index_table}) VALUES ('rebuild')",
+        )
+    ]),
+    (8, "Normalized reply bodies with compressed originals and out-of-line attachments", [
+        """CREATE TABLE IF NOT EXISTS reply_sources (
+            reply_id INTEGER PRIMARY KEY, content_type TEXT NOT NULL, body BLOB NOT NULL, raw_size INTEGER NOT NULL,
+            FOREIGN KEY (reply_id) REFERENCES ticket_replies (id) ON DELETE CASCADE
+        )""",
+        """CREATE TABLE IF NOT EXISTS reply_attachments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, reply_id INTEGER NOT NULL, filename TEXT NOT NULL,
+            content_type TEXT NOT NULL, size INTEGER NOT NULL, data BLOB NOT NULL,
+            FOREIGN KEY (reply_id) REFERENCES ticket_replies (id) ON DELETE CASCADE
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_reply_attachments_reply ON reply_attachments (reply_id)",
+        normalize_existing_replies,
+    ]),
+    (9, "In-process scheduler jobs", [
+        # Jobs run as a function call inside the app by default; 'subprocess' keeps the old isolation.
+        "ALTER TABLE scheduler_jobs ADD COLUMN mode TEXT NOT NULL DEFAULT 'inprocess' CHECK (mode IN ('inprocess', 'subprocess'))",
+    ]),
+    (10, "Scheduler job run history", [
+        """CREATE TABLE IF NOT EXISTS job_runs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, job_id INTEGER NOT NULL, started_at TEXT NOT NULL,
+            finished_at TEXT NOT NULL, duration_seconds REAL NOT NULL, status TEXT NOT NULL, items INTEGER,
+            log BLOB, log_size INTEGER NOT NULL DEFAULT 0,
+            FOREIGN KEY (job_id) REFERENCES scheduler_jobs (id) ON DELETE CASCADE
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_job_runs_job ON job_runs (job_id, started_at DESC)",
+        # Full logs now live in job_runs; drop the last one copied into every job row.
+        "UPDATE scheduler_jobs SET last_run_log = NULL WHERE interval_minutes > 0",
+    ]),
+    (11, "Per-job concurrency caps and start jitter", [
+        "ALTER TABLE scheduler_jobs ADD COLUMN max_instances INTEGER NOT NULL DEFAULT 1",
+        "ALTER TABLE scheduler_jobs ADD COLUMN jitter_seconds INTEGER NOT NULL DEFAULT 0",
+    ]),
+    (12, "Per-operation AI model routing and call log", [
+        """CREATE TABLE IF NOT EXISTS ai_models (
+            operation TEXT PRIMARY KEY, model TEXT NOT NULL, endpoint TEXT,
+            fallback_model TEXT, fallback_endpoint TEXT,
+            max_concurrency INTEGER NOT NULL DEFAULT 2, timeout_seconds REAL NOT NULL DEFAULT 120,
+            updated_at TEXT
+        )""",
+        # Every operation starts on the model it always used; a NULL endpoint means the Ollama endpoint in api_keys.
+        "INSERT OR IGNORE INTO ai_models (operation, model) VALUES ('summarize', 'mistral'), ('sanitize', 'mistral'), ('chat', 'mistral')",
+        """CREATE TABLE IF NOT EXISTS ai_calls (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, operation TEXT NOT NULL, model TEXT NOT NULL, endpoint TEXT NOT NULL,
+            route TEXT NOT NULL CHECK (route IN ('primary', 'fallback')), status TEXT NOT NULL CHECK (status IN ('ok', 'error')),
+            latency_ms REAL NOT NULL, first_token_ms REAL, error TEXT, created_at TEXT NOT NULL
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_ai_calls_created ON ai_calls (created_at)",
+    ]),
+    (13, "Sanitized reply copies", [
+        """CREATE TABLE IF NOT EXISTS reply_sanitized (
+            reply_id INTEGER PRIMARY KEY, content TEXT NOT NULL,
+            mode TEXT NOT NULL CHECK (mode IN ('fast', 'deep')), redactions INTEGER NOT NULL DEFAULT 0,
+            sanitized_at TEXT NOT NULL,
+            FOREIGN KEY (reply_id) REFERENCES ticket_replies (id) ON DELETE CASCADE
+        )""",
+    ]),
+    (14, "Backfill checkpoints", [
+        """CREATE TABLE IF NOT EXISTS backfill_checkpoints (
+            name TEXT PRIMARY KEY, last_ticket_id INTEGER NOT NULL DEFAULT 0,
+            processed INTEGER NOT NULL DEFAULT 0, failed INTEGER NOT NULL DEFAULT 0,
+            started_at TEXT, updated_at TEXT
+        )""",
+    ]),
+    (15, "User generation for session identity caching", [
+        "ALTER TABLE users ADD COLUMN generation INTEGER NOT NULL DEFAULT 0",
+    ]),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def get_schema_version(con):
+    """Returns the highest migration version applied to the database, or 0."""
+    row = con.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='schema_migrations'").fetchone()
+    if row is None:
+        return 0
+    return con.execute("SELECT COALESCE(MAX(version), 0) FROM schema_migrations").fetchone()[0]
+
+def migrate(con):
+    """Applies every pending migration, each in its own transaction. Returns the new version."""
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY, description TEXT NOT NULL, applied_at TEXT NOT NULL
+        )
+    """)
+    con.commit()
+    current = get_schema_version(con)
+    for version, description, statements in MIGRATIONS:
+        if version <= current:
+            continue
+        print(f"[*] Applying migration {version}: {description}")
+        try:
+            con.execute("BEGIN")
+            for statement in statements:
+                if callable(statement):
+                    statement(con)
+                else:
+                    con.execute(statement)
+            con.execute("INSERT INTO schema_migrations (version, description, applied_at) VALUES (?, ?, ?)",
+                        (version, description, datetime.now().isoformat(timespec='seconds')))
+            con.commit()
+        except Exception:
+            con.rollback()
+            raise
+        current = version
+    return current
+
+def rebuild_search_index(con):
+    """Rebuilds every full-text index from its source table."""
+    for index_table, _, _ in SEARCH_TABLES:
+        print(f"[*] Rebuilding {index_table}...")
+        con.execute(f"INSERT INTO {index_table} ({index_table}) VALUES ('rebuild')")
+    con.commit()
+
+def migrate_existing_database(password):
+    """Brings an existing encrypted database up to SCHEMA_VERSION in place."""
+    con = sqlite3.connect(DB_FILE)
+    con.row_factory = sqlite3.Row
+    try:
+        con.execute(f"PRAGMA key = '{password}';")
+        con.execute("PRAGMA foreign_keys = ON;")
+        before = get_schema_version(con)
+    except sqlite3.DatabaseError:
+        con.close()
+        print(f"\n[!] Incorrect password for '{DB_FILE}'. Unable to migrate.", file=sys.stderr)
+        return False
+    try:
+        if before >= SCHEMA_VERSION:
+            print(f"[*] Schema is already at version {before}. Nothing to do.")
+            return True
+        after = migrate(con)
+        print(f"[*] Schema migrated from version {before} to {after}.")
+        return True
+    except Exception as e:
+        print(f"\n[!] Migration failed, database left at its last completed version: {e}", file=sys.stderr)
+        return False
+    finally:
+        con.close()
+
 def extract_keys_from_existing_db(password):
     """
     Connects to the EXISTING tickets.db, extracts API keys, and returns them.
@@ -135,6 +385,8 @@ def create_database(password, imported_keys=None):
         get_and_set_api_keys(cur)
 
     con.commit()
+    print("\n[*] Applying schema migrations...")
+    migrate(con)
     con.close()
 
 def get_and_set_api_keys(cursor):
@@ -161,6 +413,19 @@ if __name__ == "__main__":
     print("--- Ticketing System Database Setup ---")
     imported_api_keys = None
 
+    if len(sys.argv) > 1 and sys.argv[1] in ("migrate", "rebuild-search"):
+        if not os.path.exists(DB_FILE):
+            sys.exit(f"[!] No database found at '{DB_FILE}'. Run 'python init_db.py' first.")
+        password = os.environ.get('DB_MASTER_PASSWORD') or getpass.getpass("    - Enter the database password: ")
+        if sys.argv[1] == "migrate":
+            sys.exit(0 if migrate_existing_database(password) else 1)
+        con = sqlite3.connect(DB_FILE)
+        con.execute(f"PRAGMA key = '{password}';")
+        rebuild_search_index(con)
+        con.close()
+        print("[*] Search index rebuilt.")
+        sys.exit(0)
+
     if os.path.exists(DB_FILE):
         print(f"\n[!] Existing database file ('{DB_FILE}') found.")
         reinitialize = input("    - Do you want to re-initialize it (this will back up and replace the current file)? (y/n): ").lower()
@@ -183,7 +448,12 @@ if __name__ == "__main__":
             else:
                 print("[!] Halting initialization due to key extraction failure.")
         else:
-            print("[*] Exiting without making changes.")
+            upgrade = input("    - Apply pending schema migrations to it instead (keeps all data)? (y/n): ").lower()
+            if upgrade == 'y':
+                password = getpass.getpass("    - Enter the database password: ")
+                migrate_existing_database(password)
+            else:
+                print("[*] Exiting without making changes.")
     else:
         print("\n[*] No existing database found.")
         new_password = getpass.getpass("    - Enter a master password for the NEW database: ")
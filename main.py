@@ -1,12 +1,24 @@
 import os
 import sys
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify
+import re
+import json
+import base64
+from urllib.parse import quote
+from flask import (Flask, render_template, request, redirect, url_for, flash, session, jsonify, Response, g,
+                   abort, make_response)
+from markupsafe import Markup, escape
 from datetime import datetime, timedelta
-from apscheduler.schedulers.background import BackgroundScheduler
 from werkzeug.security import generate_password_hash, check_password_hash
-from database import init_app_db, get_db, query_db, execute_db, get_db_connection
-from scheduler import run_job
-from ai_processing import summarize_text, sanitize_text, chat_with_context
+from database import (sqlite3, init_app_db, get_db, query_db, execute_db, get_db_connection,
+                      pool_metrics, get_query_count, transaction, write_metrics)
+from scheduler import (create_scheduler, load_jobs, schedule_job, validate_script_path,
+                       job_stats, get_run_log, percentile, JOB_STATS_DAYS, JOB_MODES)
+from init_db import get_schema_version, SCHEMA_VERSION
+from ai_processing import get_client, cache_metrics
+from cache import cached_lookup, invalidate, reference_cache
+from text_processing import decompress_text
+from ticket_context import build_ticket_context, estimate_tokens, CONTEXT_TOKEN_BUDGET
+from ai_queue import start_queue, get_queue, enqueue_ticket_summary, enqueue_ticket_embedding
 
 # --- App Configuration ---
 app = Flask(__name__)
@@ -14,25 +26,70 @@ app.secret_key = 'your_super_secret_key_for_production'
 app.config['DB_PASSWORD'] = None
 DATABASE = 'tickets.db'
 
-scheduler = BackgroundScheduler()
+scheduler = create_scheduler()
 init_app_db(app)
 
+# Requests running more statements than this are logged.
+QUERY_COUNT_WARN = int(os.environ.get('QUERY_COUNT_WARN', 20))
+
 # --- Helper Functions ---
+def remember_user(user):
+    """
+    Caches the user's identity in the session, tagged with the user row's generation,
+    which every edit of the user bumps in the DB so all workers see the change.
+    """
+    session['user_id'] = user['id']
+    session['username'] = user['username']
+    session['role'] = user['role']
+    session['user_generation'] = user['generation']
+
 def get_current_user():
+    """
+    Returns the logged-in user's id, username and role, once per request.
+    They come from the session unless the user was edited since it was written;
+    only the generation is read from the DB otherwise.
+    """
     # *** BUG FIX HERE ***
     # Don't try to query the DB if the password isn't even set yet.
     if not app.config.get('DB_PASSWORD'):
         return None
-        
+    if 'current_user' in g:
+        return g.current_user
+
+    user = None
     user_id = session.get('user_id')
     if user_id:
-        return query_db("SELECT * FROM users WHERE id = ?", [user_id], one=True)
-    return None
+        row = query_db("SELECT generation FROM users WHERE id = ?", [user_id], one=True)
+        if row and session.get('user_generation') == row['generation']:
+            user = {'id': user_id, 'username': session.get('username'), 'role': session.get('role')}
+        elif row:
+            user = dict(query_db("SELECT id, username, role, generation FROM users WHERE id = ?", [user_id], one=True))
+            remember_user(user)
+    g.current_user = user
+    return user
+
+# --- Reference Data ---
+# Read through the in-process cache; the write routes below invalidate what they change.
+def get_companies():
+    return cached_lookup('companies', lambda: [dict(row) for row in query_db("SELECT id, name FROM companies ORDER BY name")])
+
+def get_assignees():
+    return cached_lookup('assignees', lambda: [dict(row) for row in query_db(
+        "SELECT id, username FROM users WHERE role IN ('Admin', 'Technician') ORDER BY username")])
 
 @app.context_processor
 def inject_user():
     return dict(current_user=get_current_user())
 
+@app.after_request
+def report_query_count(response):
+    if '_database' in g:
+        count = get_query_count()
+        response.headers['X-Query-Count'] = str(count)
+        if count > QUERY_COUNT_WARN:
+            print(f"[!] {count} queries for {request.method} {request.path}", file=sys.stderr)
+    return response
+
 # --- Web Application Routes ---
 @app.before_request
 def before_request_tasks():
@@ -50,24 +107,22 @@ def unlock_db():
         try:
             # Test the password
             with get_db_connection(password_attempt) as con:
+                schema_version = get_schema_version(con)
+                if schema_version < SCHEMA_VERSION:
+                    flash(f"Database schema is at version {schema_version} but this app needs version {SCHEMA_VERSION}. "
+                          "Run 'python init_db.py migrate' and try again.", 'error')
+                    return render_template('unlock.html')
+                # Store password in app's config
+                app.config['DB_PASSWORD'] = password_attempt
+                # Set the password in the environment for other scripts to use, before
+                # the scheduler and AI queue start running jobs that need it
+                os.environ['DB_MASTER_PASSWORD'] = password_attempt
                 # If scheduler isn't running, this is the first successful login
                 if not scheduler.running:
                     print("--- First successful login. Starting background scheduler. ---")
-                    jobs = con.execute("SELECT id, script_path, interval_minutes FROM scheduler_jobs WHERE enabled = 1").fetchall()
-                    for job in jobs:
-                        scheduler.add_job(
-                            run_job,
-                            'interval',
-                            minutes=job['interval_minutes'],
-                            args=[job['id'], job['script_path'], password_attempt],
-                            id=str(job['id']),
-                            next_run_time=datetime.now() + timedelta(seconds=10) # Start after 10s
-                        )
+                    load_jobs(scheduler, con, password_attempt)
                     scheduler.start()
-            # Store password in app's config
-            app.config['DB_PASSWORD'] = password_attempt
-            # Set the password in the environment for other scripts to use
-            os.environ['DB_MASTER_PASSWORD'] = password_attempt
+                start_queue(password_attempt)
             flash('Database unlocked successfully! Please log in.', 'success')
             return redirect(url_for('user_login'))
         except (ValueError, Exception) as e:
@@ -82,8 +137,7 @@ def user_login():
         user = query_db("SELECT * FROM users WHERE username = ?", [username], one=True)
 
         if user and check_password_hash(user['password_hash'], password):
-            session['user_id'] = user['id']
-            session['role'] = user['role']
+            remember_user(user)
             flash(f"Welcome, {user['username']}!", 'success')
             return redirect(url_for('tickets_list'))
         else:
@@ -97,29 +151,233 @@ def logout():
     return redirect(url_for('unlock_db'))
 
 
+# --- Ticket List Pagination ---
+TICKET_PAGE_SIZE = 50
+TICKET_PRIORITIES = ['Low', 'Medium', 'High']
+# sort name -> (SQL column, row key used for the cursor)
+TICKET_SORTS = {
+    'updated': ('t.updated_at', 'updated_at'),
+    'created': ('t.created_at', 'created_at'),
+    'id': ('t.id', 'id'),
+}
+TICKET_FILTERS = {
+    'status': 't.status',
+    'priority': 't.priority',
+    'company_id': 't.company_id',
+    'assigned_to_id': 't.assigned_to_id',
+}
+
+def encode_cursor(value, row_id):
+    """Encodes a keyset position (sort value, id) as an opaque URL-safe token."""
+    return base64.urlsafe_b64encode(f"{value}|{row_id}".encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor, sort):
+    """Decodes a cursor made by encode_cursor, or returns None if it is missing or malformed."""
+    if not cursor:
+        return None
+    try:
+        value, row_id = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8').rsplit('|', 1)
+        row_id = int(row_id)
+        return (int(value) if sort == 'id' else value), row_id
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+def get_ticket_counts():
+    """Returns ticket totals per status from the trigger-maintained counter table."""
+    return {row['status']: row['total'] for row in query_db("SELECT status, total FROM ticket_counters")}
+
 @app.route('/')
 def tickets_list():
-    tickets = query_db("""
-        SELECT t.*, c.name as company_name, u.username as user_username
+    sort = request.args.get('sort', 'updated')
+    if sort not in TICKET_SORTS:
+        sort = 'updated'
+    direction = 'asc' if request.args.get('dir') == 'asc' else 'desc'
+    sort_column, sort_key = TICKET_SORTS[sort]
+
+    where, args, filters = [], [], {}
+    for name, column in TICKET_FILTERS.items():
+        value = request.args.get(name, '').strip()
+        if not value:
+            continue
+        if name == 'assigned_to_id' and value == 'none':
+            where.append(f"{column} IS NULL")
+        elif name.endswith('_id'):
+            if not value.isdigit():
+                continue
+            where.append(f"{column} = ?")
+            args.append(int(value))
+        else:
+            where.append(f"{column} = ?")
+            args.append(value)
+        filters[name] = value
+
+    cursor = decode_cursor(request.args.get('after'), sort)
+    if cursor:
+        where.append(f"({sort_column}, t.id) {'<' if direction == 'desc' else '>'} (?, ?)")
+        args.extend(cursor)
+
+    where_sql = f"WHERE {' AND '.join(where)}" if where else ""
+    rows = query_db(f"""
+        SELECT t.id, t.subject, t.status, t.priority, t.created_at, t.updated_at,
+               t.company_id, t.user_id, t.assigned_to_id,
+               c.name as company_name, u.username as user_username, a.username as assignee_username
         FROM tickets t
         JOIN companies c ON t.company_id = c.id
         JOIN users u ON t.user_id = u.id
-        ORDER BY t.updated_at DESC
-    """)
-    return render_template('tickets.html', tickets=tickets)
+        LEFT JOIN users a ON t.assigned_to_id = a.id
+        {where_sql}
+        ORDER BY {sort_column} {direction.upper()}, t.id {direction.upper()}
+        LIMIT ?
+    """, args + [TICKET_PAGE_SIZE + 1])
+
+    tickets = rows[:TICKET_PAGE_SIZE]
+    next_cursor = None
+    if len(rows) > TICKET_PAGE_SIZE:
+        last = tickets[-1]
+        next_cursor = encode_cursor(last[sort_key], last['id'])
+
+    counts = get_ticket_counts()
+    total = counts.get(filters['status'], 0) if 'status' in filters else sum(counts.values())
+    companies = get_companies()
+    assignees = get_assignees()
+    query_args = dict(filters, sort=sort, dir=direction)
+    return render_template('tickets.html', tickets=tickets, next_cursor=next_cursor, is_first_page=cursor is None,
+                           total=total, total_is_exact=set(filters) <= {'status'}, filters=filters,
+                           query_args=query_args, sort=sort, direction=direction,
+                           statuses=sorted(set(counts) | {'Open'}), priorities=TICKET_PRIORITIES,
+                           companies=companies, assignees=assignees)
+
+# --- Search ---
+SEARCH_PAGE_SIZE = 25
+SNIPPET_START, SNIPPET_END = '\x02', '\x03'
+
+def build_fts_query(text):
+    """Turns free text into an FTS5 query that matches all words, the last one as a prefix."""
+    words = re.findall(r'\w+', text)
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words]
+    terms[-1] += '*'
+    return ' '.join(terms)
+
+def highlight_snippet(snippet):
+    """Escapes a search snippet and turns its match markers into <mark> tags."""
+    escaped = str(escape(snippet or ''))
+    return Markup(escaped.replace(SNIPPET_START, '<mark>').replace(SNIPPET_END, '</mark>'))
+
+@app.route('/search')
+def search():
+    text = request.args.get('q', '').strip()
+    page = max(request.args.get('page', 1, type=int), 1)
+    fts_query = build_fts_query(text)
+    results = []
+    has_next = False
+    if fts_query:
+        marks = (SNIPPET_START, SNIPPET_END)
+        rows = query_db("""
+            SELECT 'Ticket' AS kind, t.id AS ticket_id, t.id AS ref_id, t.subject AS title,
+                   snippet(search_tickets, 0, ?, ?, '...', 16) AS snippet, bm25(search_tickets) AS rank
+            FROM search_tickets JOIN tickets t ON t.id = search_tickets.rowid
+            WHERE search_tickets MATCH ?
+            UNION ALL
+            SELECT 'Reply', r.ticket_id, r.id, t.subject,
+                   snippet(search_replies, 0, ?, ?, '...', 16), bm25(search_replies)
+            FROM search_replies JOIN ticket_replies r ON r.id = search_replies.rowid JOIN tickets t ON t.id = r.ticket_id
+            WHERE search_replies MATCH ?
+            UNION ALL
+            SELECT 'Company Note', NULL, n.company_id, c.name,
+                   snippet(search_company_notes, 0, ?, ?, '...', 16), bm25(search_company_notes)
+            FROM search_company_notes JOIN company_notes n ON n.id = search_company_notes.rowid JOIN companies c ON c.id = n.company_id
+            WHERE search_company_notes MATCH ?
+            UNION ALL
+            SELECT 'User Note', NULL, n.user_id, u.username,
+                   snippet(search_user_notes, 0, ?, ?, '...', 16), bm25(search_user_notes)
+            FROM search_user_notes JOIN user_notes n ON n.id = search_user_notes.rowid JOIN users u ON u.id = n.user_id
+            WHERE search_user_notes MATCH ?
+            ORDER BY rank
+            LIMIT ? OFFSET ?
+        """, [*marks, fts_query] * 4 + [SEARCH_PAGE_SIZE + 1, (page - 1) * SEARCH_PAGE_SIZE])
+        has_next = len(rows) > SEARCH_PAGE_SIZE
+        results = [dict(row, snippet=highlight_snippet(row['snippet'])) for row in rows[:SEARCH_PAGE_SIZE]]
+    return render_template('search.html', q=text, results=results, page=page, has_next=has_next)
+
+# --- Ticket Replies ---
+REPLY_PAGE_SIZE = 20
+REPLY_PREVIEW_CHARS = 600
+
+def load_reply_page(ticket_id, before=None, limit=REPLY_PAGE_SIZE):
+    """
+    Returns (replies, older_cursor): up to limit replies older than the cursor, oldest first.
+    Bodies are cut to a preview in SQL, so a page costs the same however long the thread is.
+    """
+    where, params = "r.ticket_id = ?", [REPLY_PREVIEW_CHARS + 1, ticket_id]
+    if before:
+        where += " AND (r.created_at, r.id) < (?, ?)"
+        params += list(before)
+    # Attachments ride along as a JSON array per reply rather than one query per reply.
+    rows = query_db(f"""
+        SELECT r.id, r.author_id, r.created_at, r.is_internal_note, substr(r.content, 1, ?) as preview,
+               u.username as author_name, s.raw_size as source_size,
+               (SELECT json_group_array(json_object('id', a.id, 'filename', a.filename, 'size', a.size))
+                FROM reply_attachments a WHERE a.reply_id = r.id) as attachments_json
+        FROM ticket_replies r LEFT JOIN users u ON r.author_id = u.id LEFT JOIN reply_sources s ON s.reply_id = r.id
+        WHERE {where} ORDER BY r.created_at DESC, r.id DESC LIMIT ?
+    """, params + [limit + 1])
+    older_cursor = encode_cursor(rows[limit - 1]['created_at'], rows[limit - 1]['id']) if len(rows) > limit else None
+    replies = []
+    for row in reversed(rows[:limit]):
+        reply = dict(row)
+        reply['truncated'] = len(reply['preview']) > REPLY_PREVIEW_CHARS
+        reply['preview'] = reply['preview'][:REPLY_PREVIEW_CHARS]
+        reply['attachments'] = json.loads(reply.pop('attachments_json'))
+        replies.append(reply)
+    return replies, older_cursor
 
 @app.route('/ticket/<int:ticket_id>')
 def ticket_details(ticket_id):
     ticket = query_db("SELECT t.*, c.name as company_name, u.username as user_username FROM tickets t JOIN companies c ON t.company_id = c.id JOIN users u ON t.user_id = u.id WHERE t.id = ?", [ticket_id], one=True)
-    company_notes_rows = query_db("SELECT content FROM company_notes WHERE company_id = ?", [ticket['company_id']])
-    user_notes_rows = query_db("SELECT content FROM user_notes WHERE user_id = ?", [ticket['user_id']])
-    
-    # Convert Row objects to dictionaries
-    company_notes = [dict(row) for row in company_notes_rows]
-    user_notes = [dict(row) for row in user_notes_rows]
-
-    replies = query_db("SELECT r.*, u.username as author_name FROM ticket_replies r LEFT JOIN users u ON r.author_id = u.id WHERE r.ticket_id = ? ORDER BY r.created_at ASC", [ticket_id])
-    return render_template('ticket_details.html', ticket=ticket, replies=replies, company_notes=company_notes, user_notes=user_notes)
+    replies, older_cursor = load_reply_page(ticket_id)
+    return render_template('ticket_details.html', ticket=ticket, replies=replies, older_cursor=older_cursor)
+
+@app.route('/ticket/<int:ticket_id>/replies')
+def ticket_replies(ticket_id):
+    """Returns the page of replies before the cursor, as data and as rendered HTML for the ticket page."""
+    replies, older_cursor = load_reply_page(ticket_id, before=decode_cursor(request.args.get('before'), 'created'))
+    return jsonify({'replies': replies, 'older_cursor': older_cursor,
+                    'html': render_template('_replies.html', replies=replies)})
+
+@app.route('/reply/<int:reply_id>/content')
+def reply_content(reply_id):
+    reply = query_db("SELECT id, content FROM ticket_replies WHERE id = ?", [reply_id], one=True)
+    if reply is None:
+        return jsonify({'error': 'Reply not found.'}), 404
+    return jsonify(dict(reply))
+
+@app.route('/reply/<int:reply_id>/original')
+def reply_original(reply_id):
+    """Shows the email body a reply was normalized from, as plain text so stored HTML is never rendered."""
+    source = query_db("SELECT body FROM reply_sources WHERE reply_id = ?", [reply_id], one=True)
+    if source is None:
+        return "No original body stored for this reply.", 404
+    return Response(decompress_text(source['body']), mimetype='text/plain')
+
+@app.route('/attachments/<int:attachment_id>')
+def download_attachment(attachment_id):
+    attachment = query_db("SELECT filename, content_type, data FROM reply_attachments WHERE id = ?", [attachment_id], one=True)
+    if attachment is None:
+        return "Attachment not found.", 404
+    # Always download rather than render, whatever type the sender claimed.
+    return Response(attachment['data'], mimetype='application/octet-stream',
+                    headers={'Content-Disposition': f"attachment; filename*=UTF-8''{quote(attachment['filename'])}"})
+
+@app.route('/ticket/<int:ticket_id>/context')
+def ticket_ai_context(ticket_id):
+    """Returns the context the AI tools see for a ticket, as built by the workers."""
+    context, needs_summary = build_ticket_context(get_db(), ticket_id)
+    if context is None:
+        return jsonify({'error': 'Ticket not found.'}), 404
+    return jsonify({'context': context, 'tokens': estimate_tokens(context), 'budget': CONTEXT_TOKEN_BUDGET,
+                    'summarized_pending': len(needs_summary)})
 
 @app.route('/ticket/<int:ticket_id>/reply', methods=['POST'])
 def add_reply(ticket_id):
@@ -127,18 +385,199 @@ def add_reply(ticket_id):
     current_user = get_current_user()
     if content and current_user and current_user['role'] in ['Admin', 'Technician']:
         now = datetime.now().isoformat()
-        execute_db("INSERT INTO ticket_replies (ticket_id, content, created_at, author_id) VALUES (?, ?, ?, ?)",
-                   (ticket_id, content, now, current_user['id']))
-        execute_db("UPDATE tickets SET updated_at = ? WHERE id = ?", (now, ticket_id))
+        # The reply, the ticket bump and the follow-up jobs commit together.
+        with transaction() as db:
+            execute_db("INSERT INTO ticket_replies (ticket_id, content, created_at, author_id) VALUES (?, ?, ?, ?)",
+                       (ticket_id, content, now, current_user['id']))
+            # The thread changed, so any stored summary is stale.
+            execute_db("UPDATE tickets SET updated_at = ?, summary = NULL WHERE id = ?", (now, ticket_id))
+            enqueue_ticket_summary(db, ticket_id)
+            enqueue_ticket_embedding(db, ticket_id)
         flash("Reply added successfully.", "success")
     else:
         flash("Reply content cannot be empty or you do not have permission.", "error")
     return redirect(url_for('ticket_details', ticket_id=ticket_id))
 
+@app.route('/metrics')
+def metrics():
+    job_queue = get_queue()
+    return jsonify({'db_pool': pool_metrics(), 'db_writes': write_metrics(), 'ollama': get_client().metrics(), 'ai_cache': cache_metrics(),
+                    'reference_cache': reference_cache.metrics(),
+                    'ai_queue': job_queue.metrics() if job_queue else None})
+
 @app.route('/settings')
 def settings():
-    jobs = query_db("SELECT * FROM scheduler_jobs")
-    return render_template('settings.html', jobs=jobs)
+    jobs = query_db("""
+        SELECT j.*, (SELECT id FROM job_runs r WHERE r.job_id = j.id ORDER BY r.id DESC LIMIT 1) as last_run_id
+        FROM scheduler_jobs j
+    """)
+    return render_template('settings.html', jobs=jobs, stats=job_stats(get_db()), stats_days=JOB_STATS_DAYS)
+
+@app.route('/settings/jobs/runs/<int:run_id>/log')
+def job_run_log(run_id):
+    log = get_run_log(get_db(), run_id)
+    if log is None:
+        return "No log stored for this run.", 404
+    return Response(log, mimetype='text/plain')
+
+# --- Scheduler Job Management ---
+def job_form_values(form):
+    """Reads and validates the job form. Returns (values, error)."""
+    values = {
+        'job_name': (form.get('job_name') or '').strip(),
+        'script_path': (form.get('script_path') or '').strip(),
+        'mode': form.get('mode') or 'inprocess',
+        'enabled': 1 if form.get('enabled') else 0,
+    }
+    try:
+        values['interval_minutes'] = int(form.get('interval_minutes') or 0)
+        values['max_instances'] = int(form.get('max_instances') or 1)
+        values['jitter_seconds'] = int(form.get('jitter_seconds') or 0)
+    except ValueError:
+        return values, "Interval, concurrency and jitter must be whole numbers."
+    if not values['job_name'] or not values['script_path']:
+        return values, "Job name and script are required."
+    if values['interval_minutes'] < 1:
+        return values, "The interval must be at least one minute."
+    if values['max_instances'] < 1 or values['jitter_seconds'] < 0:
+        return values, "Concurrency must be at least 1 and jitter cannot be negative."
+    if values['mode'] not in JOB_MODES:
+        return values, "Unknown job mode."
+    return values, validate_script_path(values['script_path'])
+
+def apply_job(job_id):
+    """Pushes a job's saved configuration to the running scheduler."""
+    job = query_db("SELECT * FROM scheduler_jobs WHERE id = ?", [job_id], one=True)
+    if job is not None and scheduler.running:
+        schedule_job(scheduler, job, app.config['DB_PASSWORD'])
+
+def require_admin():
+    current_user = get_current_user()
+    if not current_user or current_user['role'] != 'Admin':
+        flash("Only admins can change these settings.", "error")
+        return redirect(url_for('settings'))
+    return None
+
+@app.route('/settings/jobs/new', methods=['GET', 'POST'])
+def create_job():
+    denied = require_admin()
+    if denied:
+        return denied
+    if request.method == 'POST':
+        values, error = job_form_values(request.form)
+        if error:
+            flash(error, "error")
+            return render_template('edit_job.html', job=None, values=values, modes=JOB_MODES)
+        try:
+            cur = execute_db("""
+                INSERT INTO scheduler_jobs (job_name, script_path, interval_minutes, enabled, mode, max_instances, jitter_seconds)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, (values['job_name'], values['script_path'], values['interval_minutes'], values['enabled'],
+                  values['mode'], values['max_instances'], values['jitter_seconds']))
+        except sqlite3.IntegrityError:
+            flash("A job with that name already exists.", "error")
+            return render_template('edit_job.html', job=None, values=values, modes=JOB_MODES)
+        apply_job(cur.lastrowid)
+        flash("Job created.", "success")
+        return redirect(url_for('settings'))
+    return render_template('edit_job.html', job=None, values={'enabled': 1, 'max_instances': 1, 'jitter_seconds': 0, 'mode': 'inprocess'}, modes=JOB_MODES)
+
+@app.route('/settings/jobs/<int:job_id>/edit', methods=['GET', 'POST'])
+def edit_job(job_id):
+    denied = require_admin()
+    if denied:
+        return denied
+    job = query_db("SELECT * FROM scheduler_jobs WHERE id = ?", [job_id], one=True)
+    if job is None:
+        flash("Job not found.", "error")
+        return redirect(url_for('settings'))
+    if job['interval_minutes'] <= 0:
+        # Resident jobs like the IDLE watcher run on their own; scheduling one would start a process that never exits.
+        flash("Resident jobs report their own status and can't be edited here.", "error")
+        return redirect(url_for('settings'))
+    if request.method == 'POST':
+        values, error = job_form_values(request.form)
+        if error:
+            flash(error, "error")
+            return render_template('edit_job.html', job=job, values=values, modes=JOB_MODES)
+        try:
+            execute_db("""
+                UPDATE scheduler_jobs SET job_name = ?, script_path = ?, interval_minutes = ?, enabled = ?,
+                    mode = ?, max_instances = ?, jitter_seconds = ?
+                WHERE id = ?
+            """, (values['job_name'], values['script_path'], values['interval_minutes'], values['enabled'],
+                  values['mode'], values['max_instances'], values['jitter_seconds'], job_id))
+        except sqlite3.IntegrityError:
+            flash("A job with that name already exists.", "error")
+            return render_template('edit_job.html', job=job, values=values, modes=JOB_MODES)
+        apply_job(job_id)
+        flash("Job updated.", "success")
+        return redirect(url_for('settings'))
+    return render_template('edit_job.html', job=job, values=dict(job), modes=JOB_MODES)
+
+@app.route('/settings/jobs/<int:job_id>/toggle', methods=['POST'])
+def toggle_job(job_id):
+    denied = require_admin()
+    if denied:
+        return denied
+    # Resident jobs report their own status and are never started by the scheduler.
+    execute_db("UPDATE scheduler_jobs SET enabled = 1 - enabled WHERE id = ? AND interval_minutes > 0", (job_id,))
+    apply_job(job_id)
+    return redirect(url_for('settings'))
+
+# --- AI Model Routing ---
+AI_STATS_DAYS = 7
+
+def ai_call_stats(days=AI_STATS_DAYS):
+    """Returns per (operation, model, route) call counts, error rates and latency percentiles."""
+    cutoff = (datetime.now() - timedelta(days=days)).isoformat(timespec='seconds')
+    groups = {}
+    for row in query_db("SELECT operation, model, route, status, latency_ms, first_token_ms FROM ai_calls WHERE created_at >= ?", [cutoff]):
+        groups.setdefault((row['operation'], row['model'], row['route']), []).append(row)
+    stats = []
+    for (operation, model, route), rows in sorted(groups.items()):
+        latencies = sorted(row['latency_ms'] for row in rows if row['status'] == 'ok')
+        first_tokens = sorted(row['first_token_ms'] for row in rows if row['first_token_ms'] is not None)
+        errors = sum(1 for row in rows if row['status'] == 'error')
+        stats.append({
+            'operation': operation, 'model': model, 'route': route, 'calls': len(rows), 'errors': errors,
+            'error_rate': round(100.0 * errors / len(rows), 1),
+            'p50': percentile(latencies, 50), 'p95': percentile(latencies, 95),
+            'first_token_p50': percentile(first_tokens, 50),
+        })
+    return stats
+
+@app.route('/settings/ai-models')
+def ai_models():
+    routes = query_db("SELECT * FROM ai_models ORDER BY operation")
+    return render_template('ai_models.html', routes=routes, stats=ai_call_stats(), stats_days=AI_STATS_DAYS)
+
+@app.route('/settings/ai-models/<operation>', methods=['POST'])
+def edit_ai_model(operation):
+    denied = require_admin()
+    if denied:
+        return denied
+    form = request.form
+    model = (form.get('model') or '').strip()
+    try:
+        max_concurrency = int(form.get('max_concurrency') or 1)
+        timeout_seconds = float(form.get('timeout_seconds') or 120)
+    except ValueError:
+        max_concurrency = timeout_seconds = 0
+    if not model or max_concurrency < 1 or timeout_seconds <= 0:
+        flash("A model, a concurrency of at least 1 and a positive timeout are required.", "error")
+        return redirect(url_for('ai_models'))
+    # Blank endpoints mean the Ollama endpoint stored in api_keys.
+    execute_db("""
+        UPDATE ai_models SET model = ?, endpoint = ?, fallback_model = ?, fallback_endpoint = ?,
+            max_concurrency = ?, timeout_seconds = ?, updated_at = ?
+        WHERE operation = ?
+    """, (model, (form.get('endpoint') or '').strip() or None, (form.get('fallback_model') or '').strip() or None,
+          (form.get('fallback_endpoint') or '').strip() or None, max_concurrency, timeout_seconds,
+          datetime.now().isoformat(timespec='seconds'), operation))
+    invalidate('ai_models')
+    flash(f"Model routing for {operation} updated.", "success")
+    return redirect(url_for('ai_models'))
 
 # --- Company Management ---
 @app.route('/settings/companies')
@@ -152,6 +591,7 @@ def create_company():
         name = request.form.get('name')
         if name:
             execute_db("INSERT INTO companies (name) VALUES (?)", (name,))
+            invalidate('companies', 'pii_names')
             flash("Company created successfully.", "success")
             return redirect(url_for('list_companies'))
         else:
@@ -165,6 +605,7 @@ def edit_company(company_id):
         name = request.form.get('name')
         if name:
             execute_db("UPDATE companies SET name = ? WHERE id = ?", (name, company_id))
+            invalidate('companies', 'pii_names')
             flash("Company updated successfully.", "success")
             return redirect(url_for('list_companies'))
         else:
@@ -201,7 +642,7 @@ def list_users():
 
 @app.route('/settings/user/new', methods=['GET', 'POST'])
 def create_user():
-    companies = query_db("SELECT id, name FROM companies ORDER BY name")
+    companies = get_companies()
     if request.method == 'POST':
         username = request.form.get('username')
         email = request.form.get('email')
@@ -215,6 +656,7 @@ def create_user():
             password_hash = generate_password_hash(password)
             execute_db("INSERT INTO users (username, email, password_hash, company_id, role) VALUES (?, ?, ?, ?, ?)",
                        (username, email, password_hash, company_id, role))
+            invalidate('assignees', 'pii_names')
             flash("User created successfully.", "success")
             return redirect(url_for('list_users'))
     return render_template('edit_user.html', user=None, companies=companies, notes=[])
@@ -222,7 +664,7 @@ def create_user():
 @app.route('/settings/user/<int:user_id>/edit', methods=['GET', 'POST'])
 def edit_user(user_id):
     user = query_db("SELECT u.*, c.name as company_name FROM users u JOIN companies c ON u.company_id = c.id WHERE u.id = ?", [user_id], one=True)
-    companies = query_db("SELECT id, name FROM companies ORDER BY name")
+    companies = get_companies()
     if request.method == 'POST':
         username = request.form.get('username')
         email = request.form.get('email')
@@ -233,12 +675,15 @@ def edit_user(user_id):
         if not all([username, email, company_id, role]):
             flash("Username, email, company, and role are required.", "error")
         else:
-            if password:
-                password_hash = generate_password_hash(password)
-                execute_db("UPDATE users SET password_hash = ? WHERE id = ?", (password_hash, user_id))
-
-            execute_db("UPDATE users SET username = ?, email = ?, company_id = ?, role = ? WHERE id = ?",
-                       (username, email, company_id, role, user_id))
+            # Hash before taking the write lock; it is deliberately slow.
+            password_hash = generate_password_hash(password) if password else None
+            with transaction():
+                if password_hash:
+                    execute_db("UPDATE users SET password_hash = ? WHERE id = ?", (password_hash, user_id))
+                # Bumping the generation makes every worker re-read this user's cached session identity.
+                execute_db("UPDATE users SET username = ?, email = ?, company_id = ?, role = ?, generation = generation + 1 WHERE id = ?",
+                           (username, email, company_id, role, user_id))
+            invalidate('assignees', 'pii_names')
             flash("User updated successfully.", "success")
             return redirect(url_for('list_users'))
 
@@ -264,24 +709,77 @@ def delete_user_note(note_id):
     return redirect(url_for('list_users'))
 
 
+# --- AI Job Endpoints ---
+def submit_ai_job(operation, **fields):
+    """Queues an AI job from the posted JSON. Aborts with a 400 JSON error on a malformed ticket_id."""
+    ticket_id = request.json.get('ticket_id')
+    if ticket_id:
+        try:
+            ticket_id = int(ticket_id)
+        except (TypeError, ValueError):
+            abort(make_response(jsonify({'error': 'ticket_id must be a ticket number.'}), 400))
+        # Ticket jobs assemble their prompt from the DB; posted text is only for ad-hoc use.
+        fields = {name: value for name, value in fields.items() if name not in ('text', 'context')}
+    return get_queue().submit(operation, fields, ticket_id=ticket_id or None)
+
+def job_accepted(job_id):
+    return jsonify({'job_id': job_id, 'status_url': url_for('ai_job_status', job_id=job_id),
+                    'stream_url': url_for('ai_job_stream', job_id=job_id)}), 202
+
 @app.route('/summarize', methods=['POST'])
 def summarize():
-    text = request.json.get('text')
-    summary = summarize_text(text)
-    return jsonify({'summary': summary})
+    return job_accepted(submit_ai_job('summarize', text=request.json.get('text')))
 
 @app.route('/sanitize', methods=['POST'])
 def sanitize():
-    text = request.json.get('text')
-    sanitized = sanitize_text(text)
-    return jsonify({'sanitized': sanitized})
+    return job_accepted(submit_ai_job('sanitize', text=request.json.get('text'), deep=bool(request.json.get('deep'))))
 
 @app.route('/chat', methods=['POST'])
 def chat():
-    context = request.json.get('context')
-    question = request.json.get('question')
-    response = chat_with_context(context, question)
-    return jsonify({'response': response})
+    return job_accepted(submit_ai_job('chat', context=request.json.get('context'), question=request.json.get('question')))
+
+@app.route('/ai/jobs/<int:job_id>')
+def ai_job_status(job_id):
+    job = get_queue().get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found.'}), 404
+    return jsonify(job)
+
+# --- Streaming AI Endpoints ---
+def sse_event(data, event=None):
+    """Formats one server-sent event."""
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data)}\n\n"
+
+def stream_job_events(job_id):
+    """Pushes a job's tokens to the browser as server-sent events while a worker generates them."""
+    def generate():
+        yield sse_event({'job_id': job_id}, event='queued')
+        for kind, value in get_queue().stream(job_id):
+            if kind == 'token':
+                yield sse_event({'token': value})
+            elif kind == 'done':
+                yield sse_event({'text': value}, event='done')
+            else:
+                yield sse_event({'error': value}, event='error')
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/ai/jobs/<int:job_id>/stream')
+def ai_job_stream(job_id):
+    return stream_job_events(job_id)
+
+@app.route('/summarize/stream', methods=['POST'])
+def summarize_stream():
+    return stream_job_events(submit_ai_job('summarize', text=request.json.get('text')))
+
+@app.route('/sanitize/stream', methods=['POST'])
+def sanitize_stream():
+    return stream_job_events(submit_ai_job('sanitize', text=request.json.get('text'), deep=bool(request.json.get('deep'))))
+
+@app.route('/chat/stream', methods=['POST'])
+def chat_stream():
+    return stream_job_events(submit_ai_job('chat', context=request.json.get('context'), question=request.json.get('question')))
 
 if __name__ == '__main__':
     if not os.path.exists(DATABASE):
@@ -0,0 +1,253 @@
+import re
+import os
+import sys
+import time
+import getpass
+import argparse
+from collections import deque
+from datetime import datetime
+from database import get_pool, begin_immediate
+from cache import cached_lookup
+from ai_processing import run_operation, OllamaError
+
+# --- Redaction Settings ---
+# Replies sanitized per write transaction by the bulk pass.
+PII_BATCH_SIZE = int(os.environ.get('PII_BATCH_SIZE', 500))
+# Names shorter than this match inside ordinary words too often to redact safely.
+MIN_NAME_LENGTH = 3
+# Seeded accounts and companies whose names are ordinary words.
+IGNORED_NAMES = {n.strip().lower() for n in os.environ.get('PII_IGNORED_NAMES', 'admin,unknown,internal').split(',') if n.strip()}
+
+# One alternation so the text is scanned once; earlier groups win where they overlap.
+# Dates and times are matched only so the phone pattern can't claim them; they are kept.
+# A trailing period only blocks a match when a digit follows it, so values ending a sentence are caught.
+# Phone numbers need a leading +, a bracketed area code or grouping by spaces or dashes, so bare
+# digit runs (order ids, timestamps) and dotted build numbers are left alone.
+PII_PATTERN = re.compile(r"""
+    (?P<DATE>(?<![\w-])\d{4}-\d{2}-\d{2}(?:[ T]\d{2}:\d{2}(?::\d{2})?)?(?![\w-]))
+  | (?P<EMAIL>[A-Za-z0-9._%+-]+@[A-Za-z0-9-]+(?:\.[A-Za-z0-9-]+)*\.[A-Za-z]{2,})
+  | (?P<IP>(?<![\w.])(?:(?:25[0-5]|2[0-4]\d|1?\d?\d)\.){3}(?:25[0-5]|2[0-4]\d|1?\d?\d)(?!\w|\.\d)
+      | (?<![\w:])(?:[0-9A-Fa-f]{1,4}:){7}[0-9A-Fa-f]{1,4}(?![\w:])
+      | (?<![\w:])(?:[0-9A-Fa-f]{1,4}:){1,6}:(?:[0-9A-Fa-f]{1,4}(?::[0-9A-Fa-f]{1,4}){0,5})?(?![\w:]))
+  | (?P<CARD>(?<![\w+-])\d(?:[ -]?\d){12,18}(?![\w-]))
+  | (?P<PHONE>(?<![\w.+-])(?:\+\d[\d ()-]{6,}\d
+      | \(\d{2,5}\)[ -]?\d{3,4}[ -]?\d{3,4}
+      | \d{2,5}[ -]\d{3,4}[ -]\d{3,4})(?![\w-]|\.\d))
+""", re.VERBOSE)
+PHONE_DIGITS = (9, 15)
+
+def _luhn_valid(digits):
+    total = 0
+    for i, digit in enumerate(reversed(digits)):
+        n = int(digit)
+        if i % 2:
+            n = n * 2 - 9 if n > 4 else n * 2
+        total += n
+    return total % 10 == 0
+
+def _replace_match(match, counts):
+    kind = match.lastgroup
+    value = match.group(0)
+    if kind == 'DATE':
+        return value
+    if kind in ('CARD', 'PHONE'):
+        digits = re.sub(r"\D", "", value)
+        if kind == 'CARD' and not _luhn_valid(digits):
+            return value
+        if kind == 'PHONE' and not PHONE_DIGITS[0] <= len(digits) <= PHONE_DIGITS[1]:
+            return value
+    counts[0] += 1
+    return f"[{kind}]"
+
+class NameMatcher:
+    """
+    An Aho-Corasick automaton over the known user and company names. It finds every
+    name in a single pass over the text, case-insensitively, however many names there are.
+    """
+
+    def __init__(self, names):
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [[]]
+        for name, placeholder in names.items():
+            node = 0
+            for ch in name:
+                nxt = self._goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[node][ch] = nxt
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append([])
+                node = nxt
+            self._out[node].append((len(name), placeholder))
+        self.size = len(names)
+
+        # Breadth-first, so every fail link points at a node that is already complete.
+        pending = deque(self._goto[0].values())
+        while pending:
+            node = pending.popleft()
+            for ch, nxt in self._goto[node].items():
+                pending.append(nxt)
+                fail = self._fail[node]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[nxt] = self._goto[fail].get(ch, 0)
+                self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+
+    def find(self, text):
+        """Returns non-overlapping (start, end, placeholder) matches on word boundaries, longest first."""
+        lowered = text.lower()
+        if len(lowered) != len(text):
+            lowered = "".join(ch.lower()[:1] for ch in text)
+        matches = []
+        node = 0
+        for i, ch in enumerate(lowered):
+            while node and ch not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(ch, 0)
+            for length, placeholder in self._out[node]:
+                start, end = i - length + 1, i + 1
+                if (start == 0 or not lowered[start - 1].isalnum()) and (end == len(lowered) or not lowered[end].isalnum()):
+                    matches.append((start, end, placeholder))
+        matches.sort(key=lambda m: (m[0], m[0] - m[1]))
+        chosen = []
+        last_end = 0
+        for start, end, placeholder in matches:
+            if start >= last_end:
+                chosen.append((start, end, placeholder))
+                last_end = end
+        return chosen
+
+def load_names(con):
+    """Returns {lowercased name: placeholder} for the users and companies worth redacting."""
+    names = {}
+    for row in con.execute("SELECT name FROM companies"):
+        names[row['name'].strip().lower()] = '[COMPANY]'
+    for row in con.execute("SELECT username FROM users"):
+        # Email-style usernames are already caught by the email pattern.
+        if '@' not in row['username']:
+            names[row['username'].strip().lower()] = '[NAME]'
+    return {name: placeholder for name, placeholder in names.items()
+            if len(name) >= MIN_NAME_LENGTH and name not in IGNORED_NAMES}
+
+def get_name_matcher(con):
+    """Returns the name matcher, rebuilt at most every REFERENCE_CACHE_TTL seconds or when invalidated."""
+    return cached_lookup('pii_names', lambda: NameMatcher(load_names(con)))
+
+def redact(text, matcher=None):
+    """
+    Replaces emails, IP addresses, card and phone numbers, and any known user or
+    company names with placeholders. Returns (redacted_text, redaction_count).
+    """
+    if not text:
+        return text or '', 0
+    counts = [0]
+    text = PII_PATTERN.sub(lambda m: _replace_match(m, counts), text)
+    if matcher is not None and matcher.size:
+        parts = []
+        last = 0
+        for start, end, placeholder in matcher.find(text):
+            parts.append(text[last:start])
+            parts.append(placeholder)
+            last = end
+            counts[0] += 1
+        if parts:
+            parts.append(text[last:])
+            text = "".join(parts)
+    return text, counts[0]
+
+def sanitize(con, text, deep=False):
+    """
+    Redacts the structured PII and known names locally. In deep mode the redacted
+    text is then passed to the model routed for sanitizing, to catch free-form PII
+    such as addresses. Returns (sanitized_text, local_redaction_count).
+    """
+    text, count = redact(text, get_name_matcher(con))
+    if deep and text.strip():
+        text = run_operation('sanitize', text=text)
+    return text, count
+
+# --- Bulk Sanitizing of Historical Replies ---
+def store_sanitized_replies(con, rows, deep=False):
+    """
+    Sanitizes reply rows (id, content) and upserts their copies into reply_sanitized in
+    one write transaction. The model calls of deep mode happen before the lock is taken.
+    """
+    mode = 'deep' if deep else 'fast'
+    results = []
+    for row in rows:
+        text, count = sanitize(con, row['content'], deep=deep)
+        results.append((row['id'], text, mode, count))
+    now = datetime.now().isoformat(timespec='seconds')
+    begin_immediate(con)
+    con.executemany("""
+        INSERT INTO reply_sanitized (reply_id, content, mode, redactions, sanitized_at) VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(reply_id) DO UPDATE SET content = excluded.content, mode = excluded.mode,
+            redactions = excluded.redactions, sanitized_at = excluded.sanitized_at
+    """, [result + (now,) for result in results])
+    con.commit()
+
+def pending_replies_query(deep=False, redo=False):
+    """Returns the WHERE clause and its args selecting replies (aliased r) without a current sanitized copy."""
+    if redo:
+        return "1", ()
+    return "(s.reply_id IS NULL OR (? AND s.mode = 'fast'))", (1 if deep else 0,)
+
+def sanitize_replies(con, deep=False, batch_size=PII_BATCH_SIZE, redo=False):
+    """
+    Walks ticket_replies in id order and stores a sanitized copy of each in reply_sanitized,
+    one write transaction per batch. Replies already sanitized are skipped unless redo is set,
+    so an interrupted pass resumes where it stopped. Returns the number of replies sanitized.
+    """
+    pending, pending_args = pending_replies_query(deep, redo)
+    last_id = 0
+    done = 0
+    started = time.monotonic()
+    while True:
+        rows = con.execute(f"""
+            SELECT r.id, r.content FROM ticket_replies r
+            LEFT JOIN reply_sanitized s ON s.reply_id = r.id
+            WHERE r.id > ? AND {pending}
+            ORDER BY r.id LIMIT ?
+        """, (last_id, *pending_args, batch_size)).fetchall()
+        if not rows:
+            break
+        store_sanitized_replies(con, rows, deep=deep)
+        last_id = rows[-1]['id']
+        done += len(rows)
+        elapsed = time.monotonic() - started
+        print(f"[*] Sanitized {done} replies (up to id {last_id}, {done / elapsed if elapsed else 0:.0f}/s).")
+    return done
+
+def run(db_password):
+    """
+    Entry point for the scheduler's in-process mode: sanitizes replies added since the
+    last run on a pooled connection. Returns the number of replies sanitized.
+    """
+    with get_pool(db_password).connection() as con:
+        return sanitize_replies(con)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Store PII-redacted copies of ticket replies in reply_sanitized.")
+    parser.add_argument('--deep', action='store_true', help="also pass each redacted reply through the sanitize model (slow)")
+    parser.add_argument('--redo', action='store_true', help="re-sanitize replies that already have a sanitized copy")
+    parser.add_argument('--batch-size', type=int, default=PII_BATCH_SIZE, help="replies committed per transaction")
+    args = parser.parse_args()
+
+    DB_MASTER_PASSWORD = os.environ.get('DB_MASTER_PASSWORD')
+    if not DB_MASTER_PASSWORD:
+        try:
+            DB_MASTER_PASSWORD = getpass.getpass("Please enter the database password: ")
+        except (getpass.GetPassWarning, NameError):
+            DB_MASTER_PASSWORD = input("Please enter the database password: ")
+    if not DB_MASTER_PASSWORD:
+        sys.exit("FATAL: No database password provided. Aborting.")
+    # Deep mode reaches the model through the pool opened with this password.
+    os.environ['DB_MASTER_PASSWORD'] = DB_MASTER_PASSWORD
+    try:
+        with get_pool(DB_MASTER_PASSWORD).connection() as con:
+            total = sanitize_replies(con, deep=args.deep, batch_size=args.batch_size, redo=args.redo)
+    except OllamaError as e:
+        sys.exit(f"[!] Stopped: the sanitize model failed ({e}). Re-run to resume.")
+    print(f"[*] Done. {total} replies sanitized.")
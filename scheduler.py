@@ -1,34 +1,330 @@
 import os
 import sys
+import io
+import re
+import time
+import importlib
+import importlib.util
+import threading
+import traceback
 import subprocess
-from datetime import datetime
-from database import get_db_connection
+from datetime import datetime, timedelta
+from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.executors.pool import ThreadPoolExecutor
+from apscheduler.jobstores.base import JobLookupError
+from database import get_pool
+from text_processing import compress_text, decompress_text
 
-def run_job(job_id, script_path, password):
-    """Runs a sync script as a subprocess and logs the result."""
-    print(f"[{datetime.now()}] SCHEDULER: Running job '{job_id}': {script_path}")
-    log_output, status = "", "Failure"
+# --- Scheduler Settings ---
+SCHEDULER_WORKERS = int(os.environ.get('SCHEDULER_WORKERS', 4))
+# Subprocess jobs are killed after this long. In-process jobs can't be killed: they keep
+# running in the background, later runs are skipped until they finish, and their result
+# is recorded then.
+JOB_TIMEOUT = 300
+# In-process jobs are modules exposing this function, called with the database password.
+JOB_ENTRY_POINT = 'run'
+JOB_MODES = ('inprocess', 'subprocess')
+
+# --- Job Run History Settings ---
+# Longer logs keep their head and tail; the middle is dropped before compression.
+JOB_LOG_MAX_CHARS = int(os.environ.get('JOB_LOG_MAX_CHARS', 20000))
+JOB_RUN_RETENTION_DAYS = float(os.environ.get('JOB_RUN_RETENTION_DAYS', 30))
+JOB_RUNS_PER_JOB = int(os.environ.get('JOB_RUNS_PER_JOB', 2000))
+# Window the settings page computes durations and failure rates over.
+JOB_STATS_DAYS = float(os.environ.get('JOB_STATS_DAYS', 7))
+
+class _ThreadLocalStream:
+    """Sends writes from a thread running a job to that job's log, and everything else to the real stream."""
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._local = threading.local()
+
+    def capture(self, buffer):
+        self._local.buffer = buffer
+
+    def release(self):
+        self._local.buffer = None
+
+    def write(self, text):
+        buffer = getattr(self._local, 'buffer', None)
+        return (buffer if buffer is not None else self._stream).write(text)
+
+    def flush(self):
+        buffer = getattr(self._local, 'buffer', None)
+        if buffer is None:
+            self._stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+_capture_lock = threading.Lock()
+
+def _install_capture():
+    """Routes sys.stdout and sys.stderr through thread-local streams, once per process."""
+    with _capture_lock:
+        if not isinstance(sys.stdout, _ThreadLocalStream):
+            sys.stdout = _ThreadLocalStream(sys.stdout)
+        if not isinstance(sys.stderr, _ThreadLocalStream):
+            sys.stderr = _ThreadLocalStream(sys.stderr)
+    return sys.stdout, sys.stderr
+
+def create_scheduler(workers=SCHEDULER_WORKERS):
+    """
+    Returns the app's background scheduler. Each job runs at most once at a time,
+    and runs missed while it was busy collapse into a single catch-up run.
+    """
+    return BackgroundScheduler(
+        executors={'default': ThreadPoolExecutor(workers)},
+        job_defaults={'max_instances': 1, 'coalesce': True},
+    )
+
+def schedule_job(scheduler, job, password, start_delay=None):
+    """
+    Applies one scheduler_jobs row to the live scheduler: adds or replaces it when
+    enabled, removes it otherwise. Resident jobs (interval 0) are never scheduled.
+    """
+    if not job['enabled'] or job['interval_minutes'] <= 0:
+        unschedule_job(scheduler, job['id'])
+        return False
+    options = {}
+    if start_delay is not None:
+        options['next_run_time'] = datetime.now() + timedelta(seconds=start_delay)
+    scheduler.add_job(
+        run_job,
+        'interval',
+        minutes=job['interval_minutes'],
+        # Spreads jobs with the same interval so they don't all fire in the same second.
+        jitter=job['jitter_seconds'] or None,
+        max_instances=max(1, job['max_instances']),
+        args=[job['id'], job['script_path'], password, job['mode']],
+        id=str(job['id']),
+        name=job['job_name'],
+        replace_existing=True,
+        **options
+    )
+    return True
+
+def unschedule_job(scheduler, job_id):
+    try:
+        scheduler.remove_job(str(job_id))
+    except JobLookupError:
+        pass
+
+def load_jobs(scheduler, con, password, start_delay=10):
+    """Schedules every enabled job. Returns how many were scheduled."""
+    jobs = con.execute("SELECT * FROM scheduler_jobs WHERE enabled = 1").fetchall()
+    return sum(1 for job in jobs if schedule_job(scheduler, job, password, start_delay=start_delay))
+
+def validate_script_path(script_path):
+    """Returns an error message, or None if the job script exists next to the app."""
+    parts = script_path.split()
+    if not parts or not parts[0].endswith('.py'):
+        return "The script must be a .py file, optionally followed by arguments."
+    if os.path.isabs(parts[0]) or '..' in parts[0].replace('\\', '/').split('/'):
+        return "The script must be a path relative to the application directory."
+    if not os.path.isfile(parts[0]):
+        return f"Script '{parts[0]}' was not found."
+    return None
+
+def _load_script_module(path):
+    """Loads a job script in a subdirectory from its file, once, under a module name of its own."""
+    module_name = 'job_' + re.sub(r'\W', '_', os.path.splitext(path)[0])
+    module = sys.modules.get(module_name)
+    if module is None:
+        spec = importlib.util.spec_from_file_location(module_name, path)
+        if spec is None:
+            raise ImportError(f"Can't load '{path}'.")
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[module_name] = module
+        try:
+            spec.loader.exec_module(module)
+        except BaseException:
+            del sys.modules[module_name]
+            raise
+    return module
+
+def resolve_entry_point(script_path):
+    """
+    Returns the in-process entry function for a job script, or None if it has none.
+    Scripts next to the app are imported as the app's own modules; scripts in
+    subdirectories are loaded from their file.
+    """
+    if ' ' in script_path.strip() or not script_path.endswith('.py'):
+        return None
+    path = os.path.normpath(script_path)
     try:
-        python_executable = sys.executable
-        env = os.environ.copy()
-        env['DB_MASTER_PASSWORD'] = password
-        result = subprocess.run(
-            [python_executable, script_path],
-            capture_output=True, text=True, check=False, timeout=300,
-            encoding='utf-8', errors='replace', env=env
-        )
-        log_output = f"--- STDOUT ---\n{result.stdout}\n\n--- STDERR ---\n{result.stderr}"
-        if result.returncode == 0:
-            status = "Success"
+        if os.path.dirname(path):
+            module = _load_script_module(path)
+        else:
+            module = importlib.import_module(os.path.splitext(path)[0])
+    except (ImportError, OSError):
+        return None
+    entry = getattr(module, JOB_ENTRY_POINT, None)
+    return entry if callable(entry) else None
+
+# In-process runs that outlived the timeout, by job id, with the thread still running them.
+_overrunning = {}
+_overrun_lock = threading.Lock()
+
+def _format_log(out, err):
+    return f"--- STDOUT ---\n{out}\n\n--- STDERR ---\n{err}"
+
+def run_inprocess(entry, password, timeout=JOB_TIMEOUT, job_id=None, on_late_finish=None):
+    """
+    Calls a job's entry function on a thread of its own, capturing what it prints.
+    Returns (status, log, items) where items is whatever count the entry function returned.
+    A job still running after the timeout returns None instead and frees its scheduler slot;
+    it stays listed as overrunning until it finishes, when on_late_finish gets its result.
+    """
+    stdout, stderr = _install_capture()
+    out, err = io.StringIO(), io.StringIO()
+    outcome = {'status': "Failure", 'items': None, 'finished': False, 'late': False}
+
+    def target():
+        stdout.capture(out)
+        stderr.capture(err)
+        try:
+            result = entry(password)
+            outcome['items'] = result if isinstance(result, int) else None
+            outcome['status'] = "Success"
+        except SystemExit as e:
+            if e.code in (None, 0):
+                outcome['status'] = "Success"
+            else:
+                print(f"Job exited with status {e.code}", file=err)
+        except Exception:
+            traceback.print_exc(file=err)
+        finally:
+            stdout.release()
+            stderr.release()
+            with _overrun_lock:
+                outcome['finished'] = True
+                if outcome['late']:
+                    _overrunning.pop(job_id, None)
+            if outcome['late'] and on_late_finish is not None:
+                on_late_finish(outcome['status'], _format_log(out.getvalue(), err.getvalue()), outcome['items'])
+
+    worker = threading.Thread(target=target, name=f"job-{getattr(entry, '__module__', 'inprocess')}", daemon=True)
+    worker.start()
+    worker.join(timeout)
+    with _overrun_lock:
+        if not outcome['finished']:
+            outcome['late'] = True
+            _overrunning[job_id] = worker
+            return None
+    return outcome['status'], _format_log(out.getvalue(), err.getvalue()), outcome['items']
+
+def run_subprocess(script_path, password):
+    """Runs a job script in a fresh interpreter. Returns (status, log, items)."""
+    env = os.environ.copy()
+    env['DB_MASTER_PASSWORD'] = password
+    result = subprocess.run(
+        [sys.executable] + script_path.split(),
+        capture_output=True, text=True, check=False, timeout=JOB_TIMEOUT,
+        encoding='utf-8', errors='replace', env=env
+    )
+    status = "Success" if result.returncode == 0 else "Failure"
+    return status, _format_log(result.stdout, result.stderr), None
+
+# --- Job Run History ---
+def truncate_log(log, max_chars=JOB_LOG_MAX_CHARS):
+    if len(log) <= max_chars:
+        return log
+    half = max_chars // 2
+    return f"{log[:half]}\n\n[... {len(log) - 2 * half} characters omitted ...]\n\n{log[-half:]}"
+
+def record_run(con, job_id, started_at, finished_at, duration, status, items, log):
+    """Stores one run with its compressed, truncated log and prunes the job's old runs. Does not commit."""
+    log = truncate_log(log)
+    con.execute("""
+        INSERT INTO job_runs (job_id, started_at, finished_at, duration_seconds, status, items, log, log_size)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """, (job_id, started_at, finished_at, duration, status, items, compress_text(log), len(log)))
+    cutoff = (datetime.now() - timedelta(days=JOB_RUN_RETENTION_DAYS)).isoformat(timespec='seconds')
+    con.execute("""
+        DELETE FROM job_runs WHERE job_id = ? AND (started_at < ? OR id <= (
+            SELECT id FROM job_runs WHERE job_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?))
+    """, (job_id, cutoff, job_id, JOB_RUNS_PER_JOB))
+
+def get_run_log(con, run_id):
+    """Returns the stored log of one run, or None."""
+    row = con.execute("SELECT log FROM job_runs WHERE id = ?", (run_id,)).fetchone()
+    return decompress_text(row['log']) if row and row['log'] else None
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(1, -(-len(sorted_values) * pct // 100))
+    return sorted_values[int(rank) - 1]
+
+def job_stats(con, days=JOB_STATS_DAYS):
+    """Returns {job_id: stats} with run counts, failure rate and duration percentiles over the last days."""
+    cutoff = (datetime.now() - timedelta(days=days)).isoformat(timespec='seconds')
+    runs = {}
+    for row in con.execute("SELECT job_id, duration_seconds, status, items FROM job_runs WHERE started_at >= ?", (cutoff,)):
+        runs.setdefault(row['job_id'], []).append(row)
+    stats = {}
+    for job_id, rows in runs.items():
+        durations = sorted(row['duration_seconds'] for row in rows)
+        failures = sum(1 for row in rows if row['status'] != 'Success')
+        stats[job_id] = {
+            'runs': len(rows),
+            'failures': failures,
+            'failure_rate': round(100.0 * failures / len(rows), 1),
+            'items': sum(row['items'] or 0 for row in rows),
+            'p50': percentile(durations, 50),
+            'p95': percentile(durations, 95),
+            'p99': percentile(durations, 99),
+        }
+    return stats
+
+def run_job(job_id, script_path, password, mode='subprocess'):
+    """
+    Runs a job in-process when its module has an entry point, or as a subprocess, and records
+    the run. While an earlier in-process run is still going past its timeout, the job is skipped.
+    """
+    with _overrun_lock:
+        overrunning = job_id in _overrunning
+    if overrunning:
+        print(f"[{datetime.now()}] SCHEDULER: Skipping job '{job_id}': its previous run is still going after {JOB_TIMEOUT}s.")
+        return
+    print(f"[{datetime.now()}] SCHEDULER: Running job '{job_id}' ({mode}): {script_path}")
+    started_at = datetime.now().isoformat(timespec='seconds')
+    started = time.monotonic()
+
+    def finish(status, log_output, items):
         print(f"[{datetime.now()}] SCHEDULER: Finished job '{job_id}' with status: {status}")
-    except Exception as e:
-        log_output = f"Scheduler failed to run script: {e}"
-        print(f"[{datetime.now()}] SCHEDULER: FATAL ERROR running job '{job_id}': {e}", file=sys.stderr)
-    finally:
+        finished_at = datetime.now().isoformat(timespec='seconds')
         try:
-            with get_db_connection(password) as con:
-                con.execute("UPDATE scheduler_jobs SET last_run = ?, last_status = ?, last_run_log = ? WHERE id = ?",
-                            (datetime.now().isoformat(timespec='seconds'), status, log_output, job_id))
+            with get_pool(password).connection() as con:
+                con.execute("UPDATE scheduler_jobs SET last_run = ?, last_status = ? WHERE id = ?",
+                            (finished_at, status, job_id))
+                record_run(con, job_id, started_at, finished_at, time.monotonic() - started, status, items, log_output)
                 con.commit()
         except Exception as e:
             print(f"[{datetime.now()}] SCHEDULER: Failed to log job result to DB: {e}", file=sys.stderr)
+
+    try:
+        entry = resolve_entry_point(script_path) if mode == 'inprocess' else None
+        if entry is not None:
+            result = run_inprocess(entry, password, job_id=job_id, on_late_finish=finish)
+            if result is None:
+                print(f"[{datetime.now()}] SCHEDULER: Job '{job_id}' is still running after {JOB_TIMEOUT}s; "
+                      f"its result will be recorded when it finishes.")
+                try:
+                    with get_pool(password).connection() as con:
+                        con.execute("UPDATE scheduler_jobs SET last_status = 'Running' WHERE id = ?", (job_id,))
+                        con.commit()
+                except Exception as e:
+                    print(f"[{datetime.now()}] SCHEDULER: Failed to log job status to DB: {e}", file=sys.stderr)
+                return
+        else:
+            if mode == 'inprocess':
+                print(f"[{datetime.now()}] SCHEDULER: '{script_path}' has no {JOB_ENTRY_POINT}() entry point; running it as a subprocess.")
+            result = run_subprocess(script_path, password)
+    except Exception as e:
+        print(f"[{datetime.now()}] SCHEDULER: FATAL ERROR running job '{job_id}': {e}", file=sys.stderr)
+        result = "Failure", f"Scheduler failed to run script: {e}", None
+    finish(*result)
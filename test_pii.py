@@ -0,0 +1,29 @@
+from pii import redact, NameMatcher
+
+def test_sentence_final_values_are_redacted():
+    assert redact('Please call 555-123-4567.') == ('Please call [PHONE].', 1)
+    assert redact('My server is 10.0.0.5.') == ('My server is [IP].', 1)
+    assert redact('Reach me on +44 20 7946 0958.') == ('Reach me on [PHONE].', 1)
+    assert redact('Mail bob@example.com.') == ('Mail [EMAIL].', 1)
+
+def test_values_inside_longer_numbers_are_kept():
+    assert redact('Version 10.0.0.5.1 is out')[0] == 'Version 10.0.0.5.1 is out'
+    assert redact('See 2024-01-01 10:30 for details')[0] == 'See 2024-01-01 10:30 for details'
+
+def test_phone_formats_are_redacted():
+    assert redact('Call (555) 123-4567 or 0171 234 5678')[0] == 'Call [PHONE] or [PHONE]'
+    assert redact('Mobile: +1 555 123 4567')[0] == 'Mobile: [PHONE]'
+
+def test_version_and_order_numbers_are_kept():
+    for text in ('Windows build 10.0.19045.2965', 'Build 22631.3007', 'Order number 123456789',
+                 'Logged at 1700000000123', 'Serial 12-345-678-90'):
+        assert redact(text) == (text, 0)
+
+def test_cards_need_a_valid_checksum():
+    assert redact('card 4111 1111 1111 1111.')[0] == 'card [CARD].'
+
+def test_names_match_whole_words_only():
+    matcher = NameMatcher({'acme corp': '[COMPANY]', 'acme': '[COMPANY]', 'hers': '[NAME]'})
+    text, count = redact('ACME Corp and acme, not ushers or hersh.', matcher)
+    assert text == '[COMPANY] and [COMPANY], not ushers or hersh.'
+    assert count == 2
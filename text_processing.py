@@ -0,0 +1,87 @@
+import re
+import zlib
+from html import unescape
+from html.parser import HTMLParser
+
+# --- Body Normalization Settings ---
+# Lines made only of base64 (inline images, pasted attachments) carry nothing readable.
+BASE64_LINE = re.compile(r'^[A-Za-z0-9+/=]{60,}$')
+DATA_URI = re.compile(r'data:[\w/+.-]+;base64,[A-Za-z0-9+/=\s]+', re.IGNORECASE)
+INVISIBLE_CHARS = dict.fromkeys(map(ord, '​‌‍﻿'), None)
+HTML_TAG = re.compile(r'<(html|body|div|p|br|table|span|font|style)\b', re.IGNORECASE)
+COMPRESSION_LEVEL = 6
+
+class _HTMLTextExtractor(HTMLParser):
+    BLOCK_TAGS = {'p', 'div', 'br', 'tr', 'li', 'h1', 'h2', 'h3', 'h4', 'blockquote', 'table'}
+    SKIP_TAGS = {'script', 'style', 'head', 'title'}
+
+    def __init__(self, keep_quotes):
+        super().__init__(convert_charrefs=True)
+        self.keep_quotes = keep_quotes
+        self.parts = []
+        self._skip = 0
+        self._quote = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP_TAGS:
+            self._skip += 1
+        elif tag == 'blockquote':
+            self._quote += 1
+        if tag in self.BLOCK_TAGS:
+            self.parts.append('\n')
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP_TAGS and self._skip:
+            self._skip -= 1
+        elif tag == 'blockquote' and self._quote:
+            self._quote -= 1
+        if tag in self.BLOCK_TAGS:
+            self.parts.append('\n')
+
+    def handle_data(self, data):
+        if self._skip:
+            return
+        if self._quote:
+            # Quoted history in HTML mail lives in <blockquote>; keep it as "> " lines or drop it.
+            if not self.keep_quotes:
+                return
+            data = data.replace('\n', '\n> ')
+            if not self.parts or self.parts[-1].endswith('\n'):
+                data = '> ' + data
+        self.parts.append(data)
+
+def html_to_text(html, keep_quotes=False):
+    """Extracts readable text from an HTML email body, dropping styles, scripts and (by default) quoted blocks."""
+    parser = _HTMLTextExtractor(keep_quotes)
+    try:
+        parser.feed(html)
+        parser.close()
+    except Exception:
+        return unescape(re.sub(r'<[^>]+>', ' ', html))
+    return ''.join(parser.parts)
+
+def looks_like_html(text):
+    return bool(text and HTML_TAG.search(text))
+
+def normalize_body(text=None, html=None):
+    """
+    Reduces an email body to compact plain text: the text part when there is one,
+    otherwise the HTML converted to text, with inline base64 and excess whitespace removed.
+    Quoted history is kept as "> " lines so it can still be stripped later.
+    """
+    body = text if text and text.strip() else (html or '')
+    if looks_like_html(body):
+        body = html_to_text(body, keep_quotes=True)
+    body = DATA_URI.sub('', body).translate(INVISIBLE_CHARS).replace('\r\n', '\n').replace('\r', '\n')
+    lines = []
+    for line in body.split('\n'):
+        line = re.sub(r'[ \t ]+', ' ', line).rstrip()
+        if not BASE64_LINE.match(line.strip()):
+            lines.append(line)
+    return re.sub(r'\n{3,}', '\n\n', '\n'.join(lines)).strip()
+
+def compress_text(text):
+    return zlib.compress(text.encode('utf-8'), COMPRESSION_LEVEL)
+
+def decompress_text(blob):
+    return zlib.decompress(blob).decode('utf-8')
@@ -0,0 +1,137 @@
+import os
+import re
+import hashlib
+from text_processing import html_to_text, looks_like_html
+from ai_processing import cached_operation_result
+
+# --- Context Builder Settings ---
+CONTEXT_TOKEN_BUDGET = int(os.environ.get('CONTEXT_TOKEN_BUDGET', 3000))
+# A rough, model-agnostic estimate; good enough to keep prompts inside the context window.
+CHARS_PER_TOKEN = 4
+# Older replies without a cached summary are cut to this many characters.
+OLDER_REPLY_CHARS = 300
+
+QUOTE_HEADER_PATTERNS = [
+    re.compile(r'^\s*On .{1,200}wrote:\s*$', re.IGNORECASE),
+    re.compile(r'^\s*-{2,}\s*Original Message\s*-{2,}', re.IGNORECASE),
+    re.compile(r'^\s*_{10,}\s*$'),
+]
+# A "From:" line only starts quoted history when header fields follow it, as in
+# Outlook-style replies; on its own it may be ordinary content.
+FROM_HEADER = re.compile(r'^\s*From:\s.+$', re.IGNORECASE)
+QUOTED_HEADER_FIELD = re.compile(r'^\s*(Sent|Date|To|Cc|Subject):\s', re.IGNORECASE)
+SIGNATURE_PATTERNS = [
+    re.compile(r'^--\s*$'),
+    re.compile(r'^\s*Sent from my \w+', re.IGNORECASE),
+    re.compile(r'^\s*Get Outlook for', re.IGNORECASE),
+]
+
+def clean_reply(text):
+    """Reduces an email body to its new content: no HTML, quoted history or signature."""
+    if not text:
+        return ''
+    if looks_like_html(text):
+        text = html_to_text(text)
+    source = text.splitlines()
+    lines = []
+    for i, line in enumerate(source):
+        if any(pattern.match(line) for pattern in QUOTE_HEADER_PATTERNS + SIGNATURE_PATTERNS):
+            break
+        if FROM_HEADER.match(line) and _starts_header_block(source, i + 1):
+            break
+        if line.lstrip().startswith('>'):
+            continue
+        lines.append(line.rstrip())
+    text = '\n'.join(lines)
+    text = re.sub(r'[ \t ]+', ' ', text)
+    return re.sub(r'\n\s*\n+', '\n\n', text).strip()
+
+def _starts_header_block(lines, start):
+    """True if the next non-blank line from start is a Sent:/To:-style header field."""
+    for line in lines[start:start + 3]:
+        if line.strip():
+            return bool(QUOTED_HEADER_FIELD.match(line))
+    return False
+
+def estimate_tokens(text):
+    return len(text) // CHARS_PER_TOKEN + 1
+
+def _paragraph_key(paragraph):
+    return hashlib.sha1(' '.join(paragraph.lower().split()).encode('utf-8')).hexdigest()
+
+def load_thread(con, ticket_id):
+    """Returns the ticket's replies, oldest first, cleaned and with repeated paragraphs removed."""
+    rows = con.execute("""
+        SELECT r.id, r.content, r.created_at, u.username AS author_name
+        FROM ticket_replies r LEFT JOIN users u ON r.author_id = u.id
+        WHERE r.ticket_id = ? ORDER BY r.created_at ASC, r.id ASC
+    """, (ticket_id,)).fetchall()
+    seen = set()
+    thread = []
+    for row in rows:
+        paragraphs = []
+        for paragraph in clean_reply(row['content']).split('\n\n'):
+            key = _paragraph_key(paragraph)
+            if paragraph.strip() and key not in seen:
+                seen.add(key)
+                paragraphs.append(paragraph)
+        if paragraphs:
+            thread.append({'id': row['id'], 'author': row['author_name'] or 'Client',
+                           'created_at': row['created_at'], 'text': '\n\n'.join(paragraphs)})
+    return thread
+
+def build_notes_text(con, ticket_id):
+    """Returns the company and user notes for a ticket's requester, or None if there is no such ticket."""
+    ticket = con.execute("SELECT company_id, user_id FROM tickets WHERE id = ?", (ticket_id,)).fetchone()
+    if ticket is None:
+        return None
+    company_notes = con.execute("SELECT content FROM company_notes WHERE company_id = ? ORDER BY created_at", (ticket['company_id'],)).fetchall()
+    user_notes = con.execute("SELECT content FROM user_notes WHERE user_id = ? ORDER BY created_at", (ticket['user_id'],)).fetchall()
+    company_text = "\n".join(row['content'] for row in company_notes)
+    user_text = "\n".join(row['content'] for row in user_notes)
+    return f"COMPANY CONTEXT:\n{company_text}\n\nUSER CONTEXT:\n{user_text}"
+
+def build_ticket_context(con, ticket_id, budget=CONTEXT_TOKEN_BUDGET, include_notes=True):
+    """
+    Assembles a ticket's prompt context from the DB within a token budget.
+    The newest replies are kept whole; older ones are replaced by their cached
+    summary, or a short excerpt when none exists yet. A budget of None keeps
+    every reply whole. Returns (context, replies_needing_summary) where the second
+    item lists the excerpted replies, or (None, []) for an unknown ticket.
+    """
+    notes = build_notes_text(con, ticket_id)
+    if notes is None:
+        return None, []
+    header = f"{notes}\n\n" if include_notes else ""
+    thread = load_thread(con, ticket_id)
+
+    remaining = None if budget is None else budget - estimate_tokens(header)
+    entries = []
+    needs_summary = []
+    omitted = 0
+    # Set at the first reply that doesn't fit whole; every older reply is summarized from then on.
+    over_budget = False
+    for reply in reversed(thread):
+        label = f"[{reply['created_at']} {reply['author']}]"
+        full = f"{label}\n{reply['text']}"
+        if remaining is None or (not over_budget and estimate_tokens(full) <= remaining):
+            entry = full
+        else:
+            over_budget = True
+            summary = cached_operation_result('summarize', reply['text'])
+            if summary is None:
+                needs_summary.append(reply)
+                excerpt = reply['text'][:OLDER_REPLY_CHARS]
+                summary = excerpt + ('...' if len(reply['text']) > OLDER_REPLY_CHARS else '')
+            entry = f"{label} (summarized)\n{summary}"
+            if estimate_tokens(entry) > remaining:
+                omitted += 1
+                continue
+        entries.append(entry)
+        if remaining is not None:
+            remaining -= estimate_tokens(entry)
+
+    entries.reverse()
+    if omitted:
+        entries.insert(0, f"[{omitted} older replies omitted]")
+    return f"{header}TICKET CONTENT:\n" + "\n\n".join(entries), needs_summary